@@ -0,0 +1,552 @@
+"""
+A small benchmarking script for the server's hot paths. Like mkendpoints.py,
+it should be evoked from the command line in the base repo directory:
+
+    python3 bench.py thread_index
+
+Each benchmark builds a throwaway database from schema.sql in a temporary
+directory, fills it with fake users, threads and messages, and then times
+the same calls an endpoint makes (database queries, usermap building and
+json serialization). Nothing here touches data.sqlite.
+
+The benchmarks that call the server's own helpers import server.py when
+they run, which like running the server writes out a config.json in the
+current directory if there is none. The rest don't import it at all.
+"""
+
+from tempfile import TemporaryDirectory
+from contextlib import contextmanager
+from src import db, schema, migrations, formatting, encoder
+from src.utils import schema_values
+from threading import Thread
+from uuid import uuid1
+from sys import argv
+import urllib.request as url
+import subprocess
+import sqlite3
+import socket
+import random
+import json
+import time
+import sys
+import os
+
+
+# the tables of schema.sql without any keys or indexes, like
+# they were before src/migrations.py
+legacy_schema = """
+create table users (
+  user_id text, user_name text, auth_hash text, quip text,
+  bio text, color int, is_admin int, created real);
+create table threads (
+  thread_id text, author text, title text, last_mod real,
+  created real, reply_count int, pinned int, last_author text);
+create table messages (
+  thread_id text, post_id int, author text, created real,
+  edited int, body text, send_raw int, last_mod real);
+"""
+
+
+def make_database(path, thread_count, replies=3, user_count=50, legacy=False):
+    """
+    Create a database at PATH with THREAD_COUNT threads, each with
+    REPLIES messages following the OP, authored by USER_COUNT users.
+    When LEGACY is True, the tables are made without keys or indexes.
+    Returns an open connection to it.
+    """
+    connection = sqlite3.connect(path)
+    if legacy:
+        connection.executescript(legacy_schema)
+    else:
+        with open("schema.sql") as sql:
+            connection.executescript(sql.read())
+
+    users = [uuid1().hex for _ in range(user_count)]
+    connection.executemany(
+        "INSERT INTO users VALUES (?,?,?,?,?,?,?,?)", [
+            schema_values("user", schema.user_internal(
+                user_id, "user%d" % index, "0" * 64,
+                "", "", index % 7, False, 0))
+            for index, user_id in enumerate(users)
+        ])
+
+    now = time.time() - thread_count
+    threads, messages = list(), list()
+    for index in range(thread_count):
+        thread_id = uuid1().hex
+        author = users[index % user_count]
+        created = now + index
+        threads.append(schema_values("thread", schema.thread(
+            thread_id, author, "thread %d" % index,
+            created + replies, created, replies, False,
+            users[(index + replies) % user_count])))
+        for post_id in range(replies + 1):
+            messages.append(schema_values("message", schema.message(
+                thread_id, post_id, users[(index + post_id) % user_count],
+                created + post_id, False,
+                "[bold: post %d] of thread >>%d\n\n> quoted" % (post_id, index),
+                False, created + post_id)))
+
+    connection.executemany(
+        "INSERT INTO threads VALUES (?,?,?,?,?,?,?,?)", threads)
+    connection.executemany(
+        "INSERT INTO messages VALUES (?,?,?,?,?,?,?,?)", messages)
+    if not legacy:
+        migrations.fill_thread_summary(connection)
+        migrations.fill_search(connection)
+    connection.commit()
+    return connection
+
+
+def timeit(function, *args, repeat=5):
+    """
+    Call FUNCTION with ARGS REPEAT times and return the best wall time
+    in milliseconds.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def thread_index_endpoint(connection, include_op, include_summary=False):
+    import server
+    threads = db.thread_index(
+        connection, include_op=include_op, include_summary=include_summary)
+    usermap = server.create_usermap(connection, threads, True)
+    return json.dumps(schema.response(threads, usermap))
+
+
+def thread_index_legacy(connection, include_op):
+    # the old N+1 implementation, kept here for comparison
+    import server
+    threads = [
+        db.thread_get(connection, obj[0], False, include_op)
+        for obj in connection.execute(
+            "SELECT thread_id FROM threads ORDER BY last_mod DESC")
+    ]
+    usermap = server.create_usermap(connection, threads, True)
+    return json.dumps(schema.response(threads, usermap))
+
+
+def bench_thread_index():
+    """
+    Endpoint latency for thread_index as the thread count grows, with
+    and without include_op, and with include_summary instead. The
+    legacy loop is skipped on the larger boards because it would take
+    minutes to finish.
+    """
+    print("%8s %10s %14s %14s %14s" % (
+        "threads", "include_op", "single (ms)", "legacy (ms)", "summary (ms)"))
+    with TemporaryDirectory() as directory:
+        for count in (100, 1000, 10000, 100000):
+            connection = make_database(
+                os.path.join(directory, "%d.sqlite" % count), count)
+            for include_op in (False, True):
+                single = timeit(thread_index_endpoint, connection, include_op)
+                if count <= 1000:
+                    legacy = "%14.2f" % timeit(
+                        thread_index_legacy, connection, include_op, repeat=1)
+                else:
+                    legacy = "%14s" % "-"
+                if include_op:
+                    summary = "%14s" % "-"
+                else:
+                    summary = "%14.2f" % timeit(
+                        thread_index_endpoint, connection, False, True)
+                print("%8d %10s %14.2f %s %s" % (
+                    count, include_op, single, legacy, summary))
+            connection.close()
+
+
+def bench_indexes():
+    """
+    Latency of the lookups every request makes, on a database without
+    keys or indexes, and then again after upgrading it in place with
+    the migrations.
+    """
+    def lookups(connection):
+        users = [row[0] for row in connection.execute("SELECT user_id FROM users")]
+        threads = [row[0] for row in connection.execute(
+            "SELECT thread_id FROM threads ORDER BY random() LIMIT 20")]
+        newest = connection.execute("SELECT max(created) FROM messages").fetchone()[0]
+        return [
+            ("user_resolve", lambda: [db.user_resolve(connection, u) for u in users[:20]]),
+            ("thread_get", lambda: [db.thread_get(connection, t) for t in threads]),
+            ("message_feed", lambda: db.message_feed(connection, newest - 60)),
+            ("thread_index", lambda: db.thread_index(connection, True)),
+        ]
+
+    print("%8s %14s %12s %12s" % ("threads", "lookup", "before (ms)", "after (ms)"))
+    with TemporaryDirectory() as directory:
+        for count in (1000, 10000, 100000):
+            connection = make_database(
+                os.path.join(directory, "%d.sqlite" % count), count,
+                user_count=count // 10, legacy=True)
+            before = [(name, timeit(call, repeat=3)) for name, call in lookups(connection)]
+            migrations.upgrade(connection)
+            after = [timeit(call, repeat=3) for name, call in lookups(connection)]
+            for (name, old), new in zip(before, after):
+                print("%8d %14s %12.2f %12.2f" % (count, name, old, new))
+            connection.close()
+
+
+@contextmanager
+def serve(directory, config, port=7188):
+    """
+    Run server.py in DIRECTORY, which should contain a data.sqlite,
+    with CONFIG as its config.json. The server is stopped on exit.
+    """
+    os.makedirs(os.path.join(directory, "logs", "exceptions"), exist_ok=True)
+    with open(os.path.join(directory, "config.json"), "w") as _conf:
+        json.dump(config, _conf)
+    root = os.path.dirname(os.path.abspath(__file__))
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(root, "server.py"), "--port", str(port)],
+        cwd=directory, env=dict(os.environ, PYTHONPATH=root),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", port), 1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        else:
+            raise RuntimeError("the server did not start")
+        yield "http://127.0.0.1:%d/api/" % port
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def load(base, calls, seconds=5, clients=8):
+    """
+    Hammer the server at BASE from CLIENTS threads for SECONDS, each
+    request being a random (endpoint, body, headers) tuple from CALLS.
+    Returns the number of requests per second served.
+    """
+    counts = [0] * clients
+    deadline = time.time() + seconds
+
+    def worker(index):
+        while time.time() < deadline:
+            endpoint, body, headers = random.choice(calls)
+            request = url.Request(
+                base + endpoint, data=bytes(json.dumps(body), "utf8"),
+                headers=dict(headers, **{"Content-Type": "application/json"}))
+            with url.urlopen(request) as response:
+                response.read()
+            counts[index] += 1
+
+    workers = [Thread(target=worker, args=(index,)) for index in range(clients)]
+    [worker.start() for worker in workers]
+    [worker.join() for worker in workers]
+    return sum(counts) / seconds
+
+
+def load_calls(directory):
+    """
+    Make a board of 1000 threads in DIRECTORY and return the calls for
+    load() to make against it, one in ten of them posting a reply.
+    """
+    connection = make_database(os.path.join(directory, "data.sqlite"), 1000)
+    threads = [row[0] for row in connection.execute(
+        "SELECT thread_id FROM threads LIMIT 50")]
+    connection.close()
+    auth = {"User": "user0", "Auth": "0" * 64}
+    calls = [("get_me", {}, auth), ("thread_index", {}, {})] + [
+        ("thread_load", {"thread_id": thread_id}, auth)
+        for thread_id in threads
+    ]
+    calls += [
+        ("thread_reply", {"thread_id": thread_id, "body": "bump"}, auth)
+        for thread_id in threads[:len(calls) // 9]
+    ]
+    return calls
+
+
+def bench_load():
+    """
+    Requests per second against a live server on a board of 1000
+    threads, with one in ten requests posting a reply. This is run
+    opening a connection per request, pooled with the old rollback
+    journal, and pooled with the default (WAL) pragmas.
+    """
+    with TemporaryDirectory() as directory:
+        calls = load_calls(directory)
+        rollback = {"journal_mode": "delete", "synchronous": "full"}
+        for label, config in (
+                ("connect per request", {"db_pool_size": 0, "db_pragmas": rollback}),
+                ("pooled", {"db_pragmas": rollback}),
+                ("pooled, wal", {})):
+            with serve(directory, config) as base:
+                print("%24s %10.1f req/s" % (label, load(base, calls)))
+
+
+def bench_workers():
+    """
+    Requests per second with the same load as above, served by 1, 2
+    and 4 worker processes with each engine. The clients are threads
+    of this process, so they compete with the server for the CPU.
+    """
+    print("%8s %8s %12s" % ("engine", "workers", "req/s"))
+    with TemporaryDirectory() as directory:
+        calls = load_calls(directory)
+        for engine in ("cherrypy", "asyncio"):
+            for workers in (1, 2, 4):
+                config = {"engine": engine, "workers": workers}
+                with serve(directory, config) as base:
+                    print("%8s %8d %12.1f" % (
+                        engine, workers, load(base, calls, clients=16)))
+
+
+def bench_writes():
+    """
+    Replies per second, and how many failed, with 16 clients replying
+    to the same 5 threads at once, each request writing by itself and
+    then through the write queue, with each engine.
+    """
+    def burst(base, threads, seconds=5, clients=16):
+        counts, failures = [0] * clients, [0] * clients
+        deadline = time.time() + seconds
+        auth = {"User": "user0", "Auth": "0" * 64, "Content-Type": "application/json"}
+
+        def worker(index):
+            while time.time() < deadline:
+                request = url.Request(
+                    base + "thread_reply", headers=auth, data=bytes(json.dumps({
+                        "thread_id": random.choice(threads), "body": "bump"}), "utf8"))
+                try:
+                    with url.urlopen(request) as response:
+                        if json.loads(response.read())["error"]:
+                            failures[index] += 1
+                except OSError:
+                    failures[index] += 1
+                counts[index] += 1
+
+        workers = [Thread(target=worker, args=(index,)) for index in range(clients)]
+        [worker.start() for worker in workers]
+        [worker.join() for worker in workers]
+        return sum(counts) / seconds, sum(failures)
+
+    print("%8s %14s %12s %10s" % ("engine", "writes", "replies/s", "failed"))
+    with TemporaryDirectory() as directory:
+        connection = make_database(os.path.join(directory, "data.sqlite"), 5)
+        threads = [row[0] for row in connection.execute("SELECT thread_id FROM threads")]
+        connection.close()
+        for engine in ("cherrypy", "asyncio"):
+            for label, size in (("by request", 0), ("queued", 1000)):
+                config = {"engine": engine, "thread_pool": 32, "write_queue_size": size}
+                with serve(directory, config) as base:
+                    print("%8s %14s %12.1f %10d" % ((engine, label) + burst(base, threads)))
+
+
+def bench_client():
+    """
+    Latency of sequential calls made with network_client.BBJ against
+    a live server, on each engine: closing the connection after every
+    call, as when each one was made with urlopen, and keeping it open.
+    """
+    sys.path.insert(0, "clients")
+    from network_client import BBJ
+
+    print("%8s %14s %12s %12s" % ("engine", "endpoint", "fresh (ms)", "reused (ms)"))
+    with TemporaryDirectory() as directory:
+        connection = make_database(os.path.join(directory, "data.sqlite"), 100)
+        thread_id = connection.execute("SELECT thread_id FROM threads").fetchone()[0]
+        connection.close()
+        calls = [
+            ("get_me", {}),
+            ("thread_index", {}),
+            ("thread_load", {"thread_id": thread_id}),
+        ]
+        for engine in ("cherrypy", "asyncio"):
+            with serve(directory, {"engine": engine}):
+                client = BBJ("127.0.0.1", 7188)
+                for endpoint, params in calls:
+                    def call(fresh):
+                        for _ in range(100):
+                            client(endpoint, **params)
+                            if fresh:
+                                client.close()
+                    fresh = timeit(call, True, repeat=3) / 100
+                    reused = timeit(call, False, repeat=3) / 100
+                    print("%8s %14s %12.3f %12.3f" % (engine, endpoint, fresh, reused))
+                client.close()
+
+
+def bench_formatting():
+    """
+    thread_load?format=sequential on a 500 post thread, first with an
+    empty formatting cache and then with a hot one.
+    """
+    import server
+    with TemporaryDirectory() as directory:
+        connection = make_database(
+            os.path.join(directory, "data.sqlite"), 1, replies=499)
+        thread_id = connection.execute("SELECT thread_id FROM threads").fetchone()[0]
+
+        def thread_load():
+            thread = db.thread_get(connection, thread_id)
+            server.create_usermap(connection, thread["messages"])
+            server.do_formatting("sequential", thread["messages"])
+            return json.dumps(schema.response(thread))
+
+        formatting.cache.invalidate()
+        cold = timeit(thread_load, repeat=1)
+        hot = timeit(thread_load, repeat=10)
+        connection.close()
+    print("%10s %10.2f ms" % ("cold", cold))
+    print("%10s %10.2f ms" % ("hot", hot))
+    print("%10s %10.3f" % ("hit rate", formatting.cache.stats()["hit_rate"]))
+
+
+def bench_encoding():
+    """
+    Serializing the biggest responses: a formatted 5000 post thread_load,
+    user_map on 10000 users and thread_index on 10000 threads, with the
+    old json.dumps call, each encoder in src/encoder.py, and iterencode,
+    along with the largest chunk iterencode holds in memory at once.
+    """
+    import server
+    with TemporaryDirectory() as directory:
+        connection = make_database(
+            os.path.join(directory, "thread.sqlite"), 1, replies=4999)
+        thread_id = connection.execute("SELECT thread_id FROM threads").fetchone()[0]
+        thread = db.thread_get(connection, thread_id)
+        usermap = server.create_usermap(connection, thread["messages"])
+        server.do_formatting("sequential", thread["messages"])
+        connection.close()
+
+        connection = make_database(
+            os.path.join(directory, "board.sqlite"), 10000, replies=0,
+            user_count=10000)
+        users = db.user_resolve_many(connection, [
+            row[0] for row in connection.execute("SELECT user_id FROM users")])
+        threads = db.thread_index(connection, include_op=True)
+        index_usermap = server.create_usermap(connection, threads, True)
+        connection.close()
+
+    payloads = [
+        ("thread_load", schema.response(thread, usermap)),
+        ("user_map", schema.response(list(users), users)),
+        ("thread_index", schema.response(threads, index_usermap)),
+    ]
+    encoders = [("json.dumps", lambda obj: json.dumps(obj))]
+    encoders += sorted(encoder.ENCODERS.items())
+
+    print("%14s %12s %10s %10s" % ("payload", "encoder", "time (ms)", "size (kB)"))
+    for name, payload in payloads:
+        for encoder_name, dumps in encoders:
+            print("%14s %12s %10.2f %10d" % (
+                name, encoder_name, timeit(dumps, payload),
+                len(dumps(payload)) // 1024))
+        largest = max(len(chunk) for chunk in encoder.iterencode(payload))
+        print("%14s %12s %10.2f %10d" % (
+            name, "iterencode", timeit(lambda: list(encoder.iterencode(payload))),
+            largest // 1024))
+
+
+def sequential_expressions_legacy(string):
+    # the old character by character parser, kept here for comparison
+    directives = formatting.colors + formatting.markup
+    result = list()
+    for paragraph in formatting.parse_segments(string):
+        stack = [[None, str()]]
+        skip_iters = 0
+        nest = [None]
+        escaped = False
+        for index, char in enumerate(paragraph):
+            if skip_iters:
+                skip_iters -= 1
+                continue
+            if not escaped and char == "[":
+                directive = paragraph[index+1:paragraph.find(": ", index+1)]
+                open_p = directive in directives
+            else:
+                open_p = False
+            clsd_p = not escaped and nest[-1] != None and char == "]"
+            if open_p and nest[-1] != "linequote":
+                stack.append([directive, str()])
+                nest.append(directive)
+                skip_iters += len(directive) + 2
+            elif clsd_p:
+                nest.pop()
+                stack.append([nest[-1], str()])
+            else:
+                escaped = char == "\\"
+                try:
+                    n = paragraph[index + 1]
+                except IndexError:
+                    n = " "
+                if not (escaped and n in "[]"):
+                    stack[-1][1] += char
+        result.append([(directive, body) for directive, body in stack if body])
+    return result
+
+
+def bench_parser():
+    """
+    sequential_expressions against the old parser on pathological and
+    ordinary posts of growing size. The old parser is only run up to
+    10KB, past that the bracket heavy inputs take minutes. Before timing
+    anything, both parsers are run over a corpus of random inputs made
+    of the syntax's building blocks to check that their output is the same.
+    """
+    atoms = [
+        "[", "]", "\\", ": ", ":", " ", "x", "\n", "\n\n", ">", ">>3",
+        "**", "__", "red", "bold", "linequote", "[red: ", "[bold: ",
+        "[linequote: ", "\\[", "\\]", "[bold]", "[red:"
+    ]
+    rng = random.Random(0)
+    for _ in range(20000):
+        text = "".join(rng.choice(atoms) for _ in range(rng.randint(0, 30)))
+        if formatting.sequential_expressions(text) != sequential_expressions_legacy(text):
+            exit("the parsers disagree on %r" % text)
+    print("both parsers agree on 20000 random inputs\n")
+
+    inputs = {
+        "open brackets": "[",
+        "brackets": "[]",
+        "directives": "[red: x",
+        "nested": "[red: [bold: [blue: x]]] ",
+        "escapes": "\\[red: x\\] ",
+        "prose": "Lorem ipsum dolor sit amet, [bold: consectetur] adipiscing. ",
+    }
+    print("%14s %8s %12s %12s" % ("input", "size", "new (ms)", "legacy (ms)"))
+    for name, unit in inputs.items():
+        for size in (1000, 10000, 100000):
+            text = (unit * (size // len(unit) + 1))[:size]
+            new = timeit(formatting.sequential_expressions, text, repeat=3)
+            if size <= 10000:
+                legacy = "%12.2f" % timeit(sequential_expressions_legacy, text, repeat=1)
+            else:
+                legacy = "%12s" % "-"
+            print("%14s %8d %12.2f %s" % (name, size, new, legacy))
+
+
+benchmarks = {
+    "parser": bench_parser,
+    "formatting": bench_formatting,
+    "encoding": bench_encoding,
+    "indexes": bench_indexes,
+    "load": bench_load,
+    "client": bench_client,
+    "thread_index": bench_thread_index,
+    "workers": bench_workers,
+    "writes": bench_writes
+}
+
+
+if __name__ == "__main__":
+    names = argv[1:] or sorted(benchmarks.keys())
+    for name in names:
+        if name not in benchmarks:
+            exit("unknown benchmark %s, choose from: %s"
+                 % (name, ", ".join(sorted(benchmarks.keys()))))
+        print("### %s" % name)
+        benchmarks[name]()
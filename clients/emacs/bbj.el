@@ -132,6 +132,10 @@ or can be ommitted to send no data."
     (with-current-buffer response
       (goto-char (point-min))
       (re-search-forward "^$" nil t)
+      ;; the body is UTF-8, which json-read would otherwise take a byte
+      ;; at a time (servers using orjson send non-ASCII unescaped)
+      (set-buffer-multibyte t)
+      (decode-coding-region (point) (point-max) 'utf-8)
       (condition-case nil
           (setq json (json-read))
         (error
@@ -1,8 +1,10 @@
+from http.client import HTTPConnection, HTTPException
 from urllib.error import URLError
-import urllib.request as url
+from select import select
 from hashlib import sha256
 from time import time
 import json
+import zlib
 
 
 class BBJ(object):
@@ -57,8 +59,12 @@ class BBJ(object):
 
         Important attributes:
           .base is a string url for which all requests go to. It is
-          constructed on instantiation and the standalone host/port
-          are not stored.
+          constructed on instantiation from .host and .port.
+
+          .connection is the HTTP connection to the server. It is kept
+          open between requests, and opened again when the server has
+          closed it. Use close() to close it yourself. Because of this,
+          a BBJ object should not be shared between threads.
 
           .user_{name,auth} can be None, or strings of the username
           and the authorization hash, respectively. When both values
@@ -70,10 +76,18 @@ class BBJ(object):
           authorization information when it is available (see above).
           If you set this to False, anonymous network usage is
           guaranteed.
+
+          .etags maps requests to the ETag and raw body of their last
+          response, for the endpoints which send one. These are sent
+          back with the same requests, and when the server replies that
+          nothing changed, the stored body is used instead.
         """
         self.base = "http://{}:{}/api/%s".format(host, port)
+        self.host, self.port = host, int(port)
+        self.connection = None
         self.user_name = self.user_auth = None
         self.send_auth = True
+        self.etags = {}
         try:
             self.user = self("get_me")["data"]
         except URLError:
@@ -88,6 +102,53 @@ class BBJ(object):
         return self.request(*args, **kwargs)
 
 
+    def close(self):
+        """
+        Close the connection to the server. The next request opens
+        a new one.
+        """
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+
+    def stale(self):
+        """
+        Whether the server has closed the open connection, as it does
+        with ones that sit idle for too long. There is nothing to read
+        from a connection between requests unless it was closed.
+        """
+        sock = self.connection.sock
+        return sock is not None and bool(select([sock], [], [], 0)[0])
+
+
+    def send(self, endpoint, data, headers):
+        """
+        POST the bytes DATA with HEADERS to ENDPOINT over the open
+        connection, opening one first if there is none or the server
+        closed it. Returns a tuple of the status, headers and raw body
+        of the response. Raises URLError when the server can't be
+        reached or the connection fails before the whole response is
+        read. The request is never sent again then, as the server may
+        already have acted on it.
+        """
+        if self.connection is not None and self.stale():
+            self.close()
+        if self.connection is None:
+            self.connection = HTTPConnection(self.host, self.port)
+        try:
+            self.connection.request("POST", "/api/" + endpoint, data, headers)
+            response = self.connection.getresponse()
+            body = response.read()
+        except (OSError, HTTPException) as e:
+            self.close()
+            raise URLError(e)
+
+        if response.will_close:
+            self.close()
+        return response.status, response.headers, body
+
+
     def _hash(self, string):
         """
         Handy function to hash a password and return it.
@@ -113,7 +174,10 @@ class BBJ(object):
         See raise_exception() for details on how this function reacts
         to various failure conditions.
         """
-        headers = {"Content-Type": "application/json"}
+        headers = {
+            "Content-Type": "application/json",
+            "Accept-Encoding": "gzip, deflate"
+        }
         if params.get("no_auth"):
             params.pop("no_auth")
 
@@ -121,16 +185,21 @@ class BBJ(object):
             headers.update({"User": self.user_name, "Auth": self.user_auth})
 
         data = bytes(json.dumps(params), "utf8")
-        request = url.Request(
-            self.base % endpoint,
-            data=data,
-            headers=headers)
-
-        try:
-            with url.urlopen(request) as _r:
-                response = _r.read()
-        except url.HTTPError as e:
-            response = e.file.read()
+        cached = self.etags.get((endpoint, data))
+        if cached:
+            headers["If-None-Match"] = cached[0]
+
+        status, response_headers, response = self.send(endpoint, data, headers)
+        if status == 304 and cached:
+            response = cached[1]
+        else:
+            response = self.decompress(response, response_headers)
+            etag = response_headers.get("ETag")
+            if status < 300 and etag:
+                # only keep a handful, these can be entire threads
+                if len(self.etags) >= 32:
+                    self.etags.pop(next(iter(self.etags)))
+                self.etags[(endpoint, data)] = (etag, response)
         value = json.loads(str(response, "utf8"))
 
         if value and value.get("error"):
@@ -139,6 +208,20 @@ class BBJ(object):
         return value
 
 
+    def decompress(self, body, headers):
+        """
+        Returns the bytes of BODY, a response sent with HEADERS,
+        decompressed if the server compressed it.
+        """
+        coding = headers.get("Content-Encoding", "").lower()
+        if coding == "gzip":
+            # the window size, plus 16 to expect a gzip header
+            return zlib.decompress(body, zlib.MAX_WBITS | 16)
+        elif coding == "deflate":
+            return zlib.decompress(body)
+        return body
+
+
     def raise_exception(self, error_object):
         """
         Takes an API error object and raises the appropriate exception,
@@ -424,10 +507,12 @@ class BBJ(object):
         return response["data"]
 
 
-    def thread_index(self, include_op=False):
+    def thread_index(self, include_op=False, include_summary=False):
         """
         Returns a tuple where [0] is a list of all threads ordered by
-        most recently interacted, and [1] is a usermap object.
+        most recently interacted, and [1] is a usermap object. With
+        include_summary, each thread has a "summary" object with the
+        keys "op_preview", "last_preview" and "participants".
 
         Example:
           threads, usermap = bbj.thread_index()
@@ -435,14 +520,19 @@ class BBJ(object):
               author_id = thread["author"]
               print(usermap[author_id]["user_name"])
         """
-        response = self("thread_index", include_op=include_op)
+        response = self("thread_index",
+            include_op=include_op, include_summary=include_summary)
         return response["data"], response["usermap"]
 
 
-    def thread_load(self, thread_id, format=None, op_only=False):
+    def thread_load(self, thread_id, format=None, op_only=False,
+                    after_post_id=None, before_post_id=None, limit=None):
         """
         Returns a tuple where [0] is a thread object and [1] is a usermap object.
 
+        after_post_id, before_post_id and limit load only a page of the
+        thread's messages. See the server documentation for thread_load.
+
         Example:
           thread, usermap = bbj.thread_load(some_id)
           for message in thread["messages"]:
@@ -451,7 +541,67 @@ class BBJ(object):
               print(message["body"])
         """
         response = self("thread_load",
-            format=format, thread_id=thread_id, op_only=op_only)
+            format=format, thread_id=thread_id, op_only=op_only,
+            after_post_id=after_post_id, before_post_id=before_post_id,
+            limit=limit)
+        return response["data"], response["usermap"]
+
+
+    def thread_updates(self, thread_id, after_post_id, since=None, format=None):
+        """
+        Returns a tuple where [0] is an object with what changed in a
+        thread since it was loaded, and [1] is a usermap object. [0] has
+        the keys "thread" (its metadata), "messages" (the messages after
+        after_post_id, and the ones edited since `since`) and "time",
+        which should be passed back as `since` the next time.
+
+        Right after thread_load, use the thread's "last_mod" as `since`.
+        """
+        response = self("thread_updates",
+            thread_id=thread_id, after_post_id=after_post_id,
+            since=since, format=format)
+        return response["data"], response["usermap"]
+
+
+    def batch(self, *calls):
+        """
+        Makes each of `calls`, tuples of an endpoint name and a
+        dictionary of its arguments, in a single request to the server.
+        Returns a tuple where [0] is a list of their response objects,
+        in order, and [1] is a usermap object for all of them.
+
+        Raises an exception for the first call that failed, as request()
+        would have, but the calls after it have still been made.
+
+        Example:
+          (reply, updates), usermap = bbj.batch(
+              ("thread_reply", {"thread_id": thread_id, "body": body}),
+              ("thread_updates", {"thread_id": thread_id, "after_post_id": 0}))
+        """
+        response = self("batch", calls=[
+            {"method": endpoint, "args": args} for endpoint, args in calls
+        ])
+        for result in response["data"]:
+            if result["error"]:
+                self.raise_exception(result["error"])
+        return response["data"], response["usermap"]
+
+
+    def search(self, query, limit=None, offset=None):
+        """
+        Returns a tuple where [0] is an object with the "hits" for
+        `query`, best first, and [1] is a usermap object. Each hit
+        has the "thread_id", "post_id", "author", "created" and
+        thread "title" of a message, and a "snippet" of it around
+        the match. When there are more hits, "next" is an offset
+        to pass back in to get them.
+        """
+        params = {"query": query}
+        if limit is not None:
+            params["limit"] = limit
+        if offset is not None:
+            params["offset"] = offset
+        response = self("search", **params)
         return response["data"], response["usermap"]
 
 
@@ -488,6 +638,7 @@ class BBJ(object):
             "created": time(),
             "edited": False,
             "send_raw": False,
+            "last_mod": time(),
             "thread_id": "gibberish"
         }
 
@@ -589,7 +740,7 @@ class BBJ(object):
         return response["data"]
 
 
-    def message_feed(self, time, format=None):
+    def message_feed(self, time, format=None, limit=None, before=None):
         """
         Returns a special object representing all activity on the board since
         the argument `time`, a unix/epoch timestamp.
@@ -602,6 +753,7 @@ class BBJ(object):
                 ...more thread_id/object pairs
             },
             "messages": [...standard message object array sorted by date],
+            "next": None or a cursor for the next page,
             "usermap": {
                 ...standard user_id mapping object
             }
@@ -620,10 +772,40 @@ class BBJ(object):
 
         the optional argument `format` can be given and bahaves the same
         as `thread_load`.
+
+        `limit` caps the number of messages returned. When there are more,
+        the returned "next" value is not None and can be passed back in as
+        `before` to fetch the next (older) page.
         """
-        response = self("message_feed", time=time, format=format)
+        response = self("message_feed",
+            time=time, format=format, limit=limit, before=before)
         return {
             "usermap": response["usermap"],
             "threads": response["data"]["threads"],
-            "messages": response["data"]["messages"]
+            "messages": response["data"]["messages"],
+            "next": response["data"].get("next")
         }
+
+
+    def message_feed_wait(self, cursor=None, timeout=None, format=None):
+        """
+        Waits for new activity on the board and returns it as soon as
+        there is some, or when `timeout` seconds pass without any (the
+        server caps this). Returns the same object as `message_feed`
+        with three more keys:
+
+          "cursor": pass this back in on the next call to get what
+              happened after this one.
+          "missed": True when some activity since `cursor` is no longer
+              known to the server; reload with message_feed or
+              thread_index in that case.
+          "deleted": a list of the thread_ids of deleted threads.
+
+        Without a cursor, this waits for the next activity from now on.
+        The optional argument `format` behaves the same as `thread_load`.
+        """
+        params = {"cursor": cursor, "format": format}
+        if timeout is not None:
+            params["timeout"] = timeout
+        response = self("message_feed_wait", **params)
+        return dict(response["data"], usermap=response["usermap"])
@@ -194,7 +194,8 @@ default_prefs = {
     "date": "%Y/%m/%d",
     "time": "%H:%M",
     "frame_title": "> > T I L D E T O W N < <",
-    "max_text_width": 80
+    "max_text_width": 80,
+    "thread_page_size": 100
 }
 
 bars = {
@@ -249,8 +250,12 @@ class App(object):
         self.mode = None
         self.thread = None
         self.usermap = {}
+        # post_ids of the open thread that have not been loaded yet, and
+        # the post_ids of the messages quoting them (see MessageBody)
+        self.pending_quotes = {}
         self.window_split = False
         self.last_pos = None
+        self.last_update = None
 
         # these can be changed and manipulated by other methods
         self.walker = urwid.SimpleFocusListWalker([])
@@ -439,7 +444,7 @@ class App(object):
         buttons = []
         for pid in post_ids:
             try:
-                message = self.thread["messages"][pid]
+                message = self.get_message(pid)
                 if len(post_ids) == 1:
                     return self.quote_view_action(button, message)
                 author = self.usermap[message["author"]]
@@ -722,25 +727,167 @@ class App(object):
             self.body.attr_map = {None: "default"}
 
         self.mode = "thread"
-        thread, usermap = network.thread_load(thread_id, format="sequential")
+        # only the page around the marked post is loaded up front, the
+        # rest is fetched by load_page() as it scrolls into view
+        target = mark(thread_id)
+        thread, usermap = network.thread_load(
+            thread_id, format="sequential", **self.page_range(target))
         self.usermap.update(usermap)
+        messages = [None] * (thread["reply_count"] + 1)
+        for message in thread["messages"]:
+            if message["post_id"] < len(messages):
+                messages[message["post_id"]] = message
+        thread["messages"] = messages
         self.thread = thread
+        self.pending_quotes = {}
+        self.last_update = thread["last_mod"]
+
+        widgets = []
+        for post_id, message in enumerate(messages):
+            if message:
+                widgets += self.make_message_body(message)
+            else:
+                widgets += self.make_placeholder_body(post_id)
         self.walker.clear()
-        for message in thread["messages"]:
-            self.walker += self.make_message_body(message)
+        self.walker += widgets
         self.set_default_header()
         self.set_default_footer()
-        self.goto_post(mark(thread_id))
+        self.goto_post(target)
+
+
+    def page_range(self, post_id):
+        """
+        Returns the thread_load arguments for the page containing post_id.
+        """
+        size = self.prefs["thread_page_size"]
+        start = post_id - (post_id % size)
+        return {
+            "after_post_id": start - 1 if start else None,
+            "limit": size
+        }
+
+
+    def load_page(self, post_id, thread_id=None):
+        """
+        Fetch the page containing post_id of the open thread, and put its
+        messages in place of their placeholders. Does nothing if the post
+        is already loaded, or if the thread_id given is no longer open.
+        """
+        if self.mode != "thread" or \
+                (thread_id and thread_id != self.thread["thread_id"]):
+            return
+
+        messages = self.thread["messages"]
+        if not 0 <= post_id < len(messages) or messages[post_id]:
+            return
+
+        thread, usermap = network.thread_load(
+            self.thread["thread_id"], format="sequential",
+            **self.page_range(post_id))
+        self.usermap.update(usermap)
+        quoting = set()
+        for message in thread["messages"]:
+            pid = message["post_id"]
+            if pid < len(messages) and not messages[pid]:
+                messages[pid] = message
+                self.walker[pid * 5:(pid + 1) * 5] = self.make_message_body(message)
+                quoting |= self.pending_quotes.pop(pid, set())
+
+        # the messages quoting these were drawn before their authors were
+        # known, so draw them again with them
+        for pid in sorted(quoting):
+            if messages[pid]:
+                self.walker[pid * 5:(pid + 1) * 5] = self.make_message_body(messages[pid])
+
+
+    def get_message(self, post_id):
+        """
+        Returns the message for post_id from the open thread, loading
+        its page first if needed. Raises IndexError for posts that do
+        not exist, like the thread["messages"] list itself would.
+        """
+        if post_id < 0:
+            raise IndexError(post_id)
+        self.load_page(post_id)
+        return self.thread["messages"][post_id]
+
+
+    def make_placeholder_body(self, post_id):
+        """
+        Returns stand-in widgets for a message that has not been loaded yet.
+        There are as many as make_message_body() returns, so that the
+        position of every post in the walker stays the same.
+        """
+        return [
+            PostPlaceholder(self.thread["thread_id"], post_id),
+            urwid.Divider(),
+            urwid.Divider(),
+            urwid.Divider(),
+            urwid.AttrMap(urwid.Divider("-"), "dim")
+        ]
 
 
     def refresh(self):
         self.remove_overlays()
         if self.mode == "index":
             return self.index()
-        mark()
-        thread = self.thread["thread_id"]
-        self.thread_load(None, thread)
-        self.goto_post(mark(thread))
+        self.thread_update()
+
+
+    def thread_update(self):
+        """
+        Fetch only the new and changed posts of the open thread, and
+        patch them into the walker in place of the old ones.
+        """
+        updates, usermap = network.thread_updates(**self.thread_updates_args())
+        self.apply_updates(updates, usermap)
+
+
+    def thread_updates_args(self):
+        return {
+            "thread_id": self.thread["thread_id"],
+            "after_post_id": len(self.thread["messages"]) - 1,
+            "since": self.last_update,
+            "format": "sequential"
+        }
+
+
+    def apply_updates(self, updates, usermap):
+        """
+        Patch the thread_updates object UPDATES into the open thread.
+        """
+        messages = self.thread["messages"]
+        self.usermap.update(usermap)
+        self.last_update = updates["time"]
+
+        for message in updates["messages"]:
+            pid = message["post_id"]
+            if pid < len(messages):
+                messages[pid] = message
+                self.walker[pid * 5:(pid + 1) * 5] = self.make_message_body(message)
+            else:
+                messages.append(message)
+                self.walker += self.make_message_body(message)
+
+        thread = updates["thread"]
+        thread["messages"] = messages
+        self.thread = thread
+
+
+    def submit(self, endpoint, params):
+        """
+        Send a post from the composer to ENDPOINT with PARAMS and
+        refresh the view. In a thread, its updates are fetched in
+        the same request.
+        """
+        if self.mode != "thread":
+            network.request(endpoint, **params)
+            return self.refresh()
+
+        (_, updates), usermap = network.batch(
+            (endpoint, params), ("thread_updates", self.thread_updates_args()))
+        self.remove_overlays()
+        self.apply_updates(updates["data"], usermap)
 
 
     def back(self, terminate=False):
@@ -809,6 +956,7 @@ class App(object):
         if self.mode != "thread":
             return
 
+        self.load_page(number)
         size = self.loop.screen_size
         new_pos = number * 5
         cur_pos = self.box.get_focus_path()[0]
@@ -853,7 +1001,7 @@ class App(object):
     def jump_peek(self, editor, value, display):
         if not value:
             return display.set_text("")
-        msg = self.thread["messages"][int(value)]
+        msg = self.get_message(int(value))
         author = self.usermap[msg["author"]]
         display.set_text((str(author["color"]), ">>%s %s" % (value, author["user_name"])))
 
@@ -1301,8 +1449,7 @@ class App(object):
                 endpoint = "thread_create"
                 params.update({"title": title})
 
-            network.request(endpoint, **params)
-            self.refresh()
+            self.submit(endpoint, params)
             if edit:
                 self.goto_post(edit["post_id"])
 
@@ -1398,23 +1545,34 @@ class MessageBody(urwid.Text):
                         continue
 
                     color = "2"
+                    display = ""
+                    messages = app.thread["messages"] if app.thread else []
                     try:
+                        quoted_id = int(body)
+                    except ValueError:
+                        quoted_id = -1
+                    # the quote may be garbage and refer to a nonexistant post
+                    if 0 <= quoted_id < len(messages):
                         # we can get this quote by its index in the thread
-                        message = app.thread["messages"][int(body)]
-                        user = app.usermap[message["author"]]
-                        # try to get the user's color, if its default use the normal one
-                        _c = user["color"]
-                        if _c != 0:
-                            color = str(_c)
-
-                        if user != "anonymous" and user["user_name"] == network.user_name:
-                            display = "[You]"
-                            # bold it
-                            color += "0"
+                        quoted = messages[quoted_id]
+                        if quoted is None:
+                            # its page isn't loaded yet, so it goes without
+                            # its author until load_page draws this again
+                            app.pending_quotes.setdefault(quoted_id, set()).add(
+                                message["post_id"])
                         else:
-                            display = "[%s]" % user["user_name"]
-                    except: # the quote may be garbage and refer to a nonexistant post
-                        display = ""
+                            user = app.usermap[quoted["author"]]
+                            # try to get the user's color, if its default use the normal one
+                            _c = user["color"]
+                            if _c != 0:
+                                color = str(_c)
+
+                            if user != "anonymous" and user["user_name"] == network.user_name:
+                                display = "[You]"
+                                # bold it
+                                color += "0"
+                            else:
+                                display = "[%s]" % user["user_name"]
                     result.append((color, ">>%s%s" % (body, display)))
 
                 elif directive == "rainbow":
@@ -1433,6 +1591,24 @@ class MessageBody(urwid.Text):
         super(MessageBody, self).__init__(result)
 
 
+class PostPlaceholder(urwid.Text):
+    """
+    Stands in for a message of a thread that has not been loaded yet.
+    Once it is drawn on screen, it asks the app to load its page.
+    """
+    def __init__(self, thread_id, post_id):
+        self.thread_id = thread_id
+        self.post_id = post_id
+        super(PostPlaceholder, self).__init__(("dim", ">%d loading..." % post_id))
+
+
+    def render(self, size, focus=False):
+        # the walker can't be changed in the middle of drawing it,
+        # so the page is loaded right after instead
+        app.loop.set_alarm_in(0, lambda *_: app.load_page(self.post_id, self.thread_id))
+        return super(PostPlaceholder, self).render(size, focus)
+
+
 class Prompt(urwid.Edit):
     """
     Supports basic bashmacs keybinds. Key casing is
@@ -1588,8 +1764,7 @@ class ExternalEditor(urwid.Terminal):
 
         if body and not re.search("^>>[0-9]+$", body):
             self.params.update({"body": body})
-            network.request(self.endpoint, **self.params)
-            app.refresh()
+            app.submit(self.endpoint, self.params)
             if self.endpoint == "edit_post":
                 app.goto_post(self.params["post_id"])
 
@@ -1786,7 +1961,7 @@ class ActionBox(urwid.ListBox):
             app.loop.start()
 
         elif app.mode == "thread" and not app.window_split and not overlay:
-            message = app.thread["messages"][app.get_focus_post()]
+            message = app.get_message(app.get_focus_post())
 
             if keyl == "ctrl e":
                 app.edit_post(None, message)
@@ -1,9 +1,20 @@
+"""
+Upgrades an existing database in place to the current schema. Takes the
+path of the database as an optional argument, defaulting to data.sqlite.
+It is safe to run this more than once: migrations which were already
+applied are skipped. See src/migrations.py for the migrations themselves.
+"""
+
+from src import migrations
+from sys import argv
 import sqlite3
 
-with sqlite3.connect("data.sqlite") as _con:
-    _con.execute('ALTER TABLE threads ADD COLUMN last_author text DEFAULT ""')
-    _con.commit()
-    for tid in _con.execute("SELECT thread_id FROM threads"):
-        author = _con.execute("SELECT author FROM messages WHERE thread_id = ? ORDER BY post_id", tid).fetchall()[-1]
-        _con.execute("UPDATE threads SET last_author = ? WHERE thread_id = ?", author + tid)
-    _con.commit()
+path = argv[1] if len(argv) > 1 else "data.sqlite"
+
+with sqlite3.connect(path) as _con:
+    before = migrations.version(_con)
+    after = migrations.upgrade(_con, log=lambda name: print("applying", name))
+    if before == after:
+        print("%s is up to date (version %d)" % (path, after))
+    else:
+        print("upgraded %s from version %d to %d" % (path, before, after))
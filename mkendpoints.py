@@ -99,6 +99,13 @@ visualation) Errors follow a strict code system, making it easy for your client
 to map these responses to native exception types or signals in your language of
 choice. See [the full error page](errors.md) for details.
 
+## Caching
+
+`thread_index` and `thread_load` send an `ETag` header with their responses.
+If you send it back in an `If-None-Match` header on the next identical request,
+and nothing has changed since, the server replies with an empty
+`304 Not Modified` response instead, and you can keep using the copy you have.
+
 
 """
 
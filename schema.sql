@@ -1,6 +1,9 @@
 drop table if exists users;
 drop table if exists threads;
 drop table if exists messages;
+drop table if exists thread_summary;
+drop table if exists search;
+drop table if exists search_rows;
 
 
 create table users (
@@ -34,5 +37,52 @@ create table messages (
   created real,     -- floating point unix timestamp (when reply was posted)
   edited int,       -- bool
   body text,        -- string
-  send_raw int      -- bool (1/true == never apply formatting)
+  send_raw int,     -- bool (1/true == never apply formatting)
+  last_mod real,    -- floating point unix timestamp (of posting or last edit)
+  primary key (thread_id, post_id)
 );
+
+
+-- kept up to date by every write to a thread, so the index can show
+-- a glimpse of each thread without reading its messages
+create table thread_summary (
+  thread_id text primary key, -- uuid string (of the thread summarized)
+  op_preview text,            -- string (start of the original post's body)
+  last_preview text,          -- string (start of the last message's body)
+  participants int            -- integer (distinct authors of its undeleted messages)
+);
+
+
+-- the full text index of message bodies and thread titles. Each message
+-- has a row, except deleted ones, and each thread's title is indexed
+-- along with its OP.
+create virtual table search using fts5(
+  title,                  -- string (the thread title, for OPs only)
+  body,                   -- string (the unformatted message body)
+  thread_id unindexed,    -- string (uuid1 of the message's thread)
+  post_id unindexed       -- integer (the message's post_id)
+);
+
+-- the row of search for each message, so it can be found to update
+create table search_rows (
+  thread_id text,   -- string (uuid1 of parent thread)
+  post_id int,      -- integer
+  search_rowid int, -- integer (rowid of the message's row in search)
+  primary key (thread_id, post_id)
+) without rowid;
+
+
+-- users are resolved by either their id or name on every request
+create unique index users_user_id on users(user_id);
+create unique index users_user_name on users(user_name);
+
+create unique index threads_thread_id on threads(thread_id);
+-- the thread index is ordered by last_mod
+create index threads_last_mod on threads(last_mod);
+
+-- message_feed selects and orders messages by their submission time
+create index messages_created on messages(created, thread_id, post_id);
+
+
+-- the number of migrations in src/migrations.py this schema is up to date with
+pragma user_version = 6;
@@ -0,0 +1,22 @@
+"""
+Rebuilds the full text search index of a database from its messages.
+Takes the path of the database as an optional argument, defaulting to
+data.sqlite. The index is kept up to date by the server, so this is only
+needed when messages were changed without it, or to compact the index.
+dbupdate.py builds the index when it adds it to an older database.
+"""
+
+from src import migrations
+from sys import argv
+import sqlite3
+import time
+
+path = argv[1] if len(argv) > 1 else "data.sqlite"
+
+with sqlite3.connect(path) as _con:
+    if migrations.outdated(_con):
+        exit("%s is out of date, upgrade it with dbupdate.py first" % path)
+    start = time.time()
+    migrations.fill_search(_con)
+    count = _con.execute("SELECT count(*) FROM search_rows").fetchone()[0]
+    print("indexed %d messages in %.1f seconds" % (count, time.time() - start))
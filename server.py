@@ -1,11 +1,25 @@
 from src.exceptions import BBJException, BBJParameterError, BBJUserError
-from src import db, schema, formatting
+from src import db, schema, formatting, migrations, encoder
+from src.pool import ConnectionPool
+from src.events import EventLog
+from src.cache import LRUCache
+from src.asyncserver import AsyncServer, Notifier
+from src.writer import WriteQueue
+from src.metrics import Metrics
+from cherrypy.process.plugins import Monitor
 from functools import wraps
+from itertools import chain
+from hashlib import sha1
 from uuid import uuid1
 from sys import argv
 import traceback
+import zlib
 import cherrypy
-import sqlite3
+import asyncio
+import socket
+import signal
+import time
+import os
 import json
 
 dbname = "data.sqlite"
@@ -17,17 +31,123 @@ app_config = {
     "host": "127.0.0.1",
     "instance_name": "BBJ",
     "allow_anon": True,
-    "debug": False
+    "debug": False,
+    # the HTTP server to run on: "cherrypy", or "asyncio" to serve from an
+    # event loop with the API methods on a pool of thread_pool workers
+    "engine": "cherrypy",
+    # the number of processes to serve from. Each has its own database
+    # connections, caches and threads, sized by the options below. More
+    # than one disables message_feed_wait, as its events are only seen
+    # by the process they happened in.
+    "workers": 1,
+    # the most database connections to keep open at once (0 disables
+    # pooling), and how long a request may wait for a free one
+    "db_pool_size": 10,
+    "db_pool_timeout": 10,
+    # SQLite pragmas to apply to each connection when it is opened. Any
+    # pragma may be added here; the ones given in config.json are merged
+    # with these rather than replacing them all.
+    "db_pragmas": {
+        # readers are never blocked by a writer in WAL mode
+        "journal_mode": "wal",
+        # in WAL mode, NORMAL only syncs on checkpoints and is still safe
+        # against corruption (a power loss may roll back the last commits)
+        "synchronous": "normal",
+        # negative values are in KiB rather than pages
+        "cache_size": -16000,
+        "mmap_size": 268435456,
+        # milliseconds to wait on a locked database before giving up
+        "busy_timeout": 5000,
+        # requests never checkpoint the WAL themselves, see below
+        "wal_autocheckpoint": 0,
+        "journal_size_limit": 67108864
+    },
+    # seconds between the background checkpoints of the WAL into the
+    # database. These are passive, so they never wait on readers or
+    # writers. If this is 0, set wal_autocheckpoint above to a number
+    # of pages instead or the WAL will grow without bound.
+    "db_checkpoint_interval": 10,
+    # new threads, replies and edits are written by a single writer
+    # thread, which commits the ones that queue up while it is busy all
+    # at once. At most write_queue_size writes may wait for it (0 makes
+    # each request write by itself instead), write_batch_size of them
+    # are committed together, and the writer waits up to
+    # write_batch_delay seconds for more writes to join a batch.
+    "write_queue_size": 1000,
+    "write_batch_size": 100,
+    "write_batch_delay": 0,
+    # the most users to keep in memory for authorization and usermaps,
+    # and the seconds to keep each one for. Changes made to users from
+    # outside the server, like making one an admin or replacing their
+    # auth_hash with sqlite3, take effect once their entries expire.
+    "user_cache_size": 1000,
+    "user_cache_ttl": 10,
+    # the most messages to keep formatted output in memory for
+    "format_cache_size": 10000,
+    # the most serialized responses to keep for endpoints with ETags
+    "response_cache_size": 256,
+    # the library to encode responses with: "json", "orjson", or "auto"
+    # for the fastest one installed. orjson sends text outside of ASCII
+    # as UTF-8 rather than \u escapes; set "json" if a client can't
+    # decode it.
+    "json_encoder": "auto",
+    # responses of at least compress_min_size bytes are compressed for
+    # clients that send Accept-Encoding: gzip or deflate, at zlib level
+    # compress_level (1 is fastest, 9 smallest, 0 disables compression)
+    "compress_min_size": 1024,
+    "compress_level": 6,
+    # request threads for the HTTP server
+    "thread_pool": 10,
+    # message_feed_wait: the longest a request may wait for activity,
+    # how many may wait at once and how many recent events are kept
+    # for them. With CherryPy, waiting requests each hold a request
+    # thread and a database connection, so room is made for them on
+    # top of the thread_pool and db_pool_size above. The asyncio engine
+    # parks them on its event loop instead, where they hold neither
+    # and this can be set to thousands.
+    "poll_timeout": 30,
+    "poll_max_waiters": 10,
+    "event_log_size": 1000
 }
 
 
 try:
     with open("config.json") as _conf:
-        app_config.update(json.load(_conf))
+        for key, value in json.load(_conf).items():
+            if isinstance(app_config.get(key), dict):
+                app_config[key].update(value)
+            else:
+                app_config[key] = value
 except FileNotFoundError:
     with open("config.json", "w") as _conf:
         json.dump(app_config, _conf)
 
+# the connection pool is created in run(), and the write queue (unless
+# it is disabled) by each process serving requests in serve()
+pool = None
+writer = None
+
+# the API object being served, and for the asyncio engine, the server,
+# the Notifier woken up by each new event and the number of requests
+# parked waiting for one (see park_waiter)
+api = None
+engine = None
+activity = None
+parked = 0
+
+# serialized responses of the endpoints with a version (see below), keyed
+# by their ETag and the coding they were compressed with. Each is stored
+# along with that coding, or None if it was too small to compress. The
+# server sets its size from the config.
+responses = LRUCache(256)
+
+# mixed into every ETag, so that the tags given out before a restart,
+# when db.writes was counting from zero again, can never match
+instance = uuid1().hex
+
+# the counts and timings of the requests to each API method, see metrics
+request_metrics = Metrics()
+
 
 def api_method(function):
     """
@@ -41,76 +161,340 @@ def api_method(function):
     exceptions will throw a code 1 back at the client and log
     it for inspection. Errors related to JSON decoding are
     caught as well and returned to the client as code 0.
+
+    Methods may be given a `version` attribute: a function taking the
+    connection and the arguments, that returns a value which changes
+    whenever the method's response would (or None to opt out). An ETag
+    is made from it, and when the client sends the same tag back in
+    If-None-Match, an empty 304 response is returned instead. Otherwise
+    the serialized response is cached under its ETag.
+
+    Responses are compressed for the clients that accept it, see
+    content_coding().
+
+    Methods with a `content_type` attribute return a string, which is
+    sent as it is with that Content-Type instead of as JSON. Their
+    errors are still sent as JSON.
+
+    Every request is counted and timed in request_metrics, see measure().
+
+    The work is done by handle(), which does not depend on CherryPy,
+    so the asyncio engine can call the same methods.
     """
     function.exposed = True
 
     @wraps(function)
     def wrapper(self, *args, **kwargs):
-        response = None
-        debug = app_config["debug"]
-        try:
-            connection = sqlite3.connect(dbname)
-            # read in the body from the request to a string...
-            if cherrypy.request.method == "POST":
-                read_in = str(cherrypy.request.body.read(), "utf8")
-                if not read_in:
-                    # the body may be empty, not all methods require input
-                    body = {}
-                else:
-                    body = json.loads(read_in)
-                    if not isinstance(body, dict):
-                        raise BBJParameterError("Non-JSONObject input")
-                    # lowercase all of its top-level keys
-                    body = {key.lower(): value for key, value in body.items()}
-            else:
-                body = {}
+        if cherrypy.request.method == "POST":
+            read_in = cherrypy.request.body.read()
+        else:
+            read_in = b""
+        status, headers, chunks = handle(
+            self, wrapper, read_in, cherrypy.request.headers)
+        cherrypy.response.status = status
+        cherrypy.response.headers.update(headers)
+        chunks = iter(chunks)
+        first = next(chunks, b"")
+        second = next(chunks, None)
+        if second is None:
+            return first
+        # stream the rest as it is encoded
+        cherrypy.response.stream = True
+        return chain((first, second), chunks)
+
+    return wrapper
+
+
+def authorize(connection, headers):
+    """
+    Returns the user who sent a request with HEADERS, or anonymous.
+    """
+    username = headers.get("User")
+    auth = headers.get("Auth")
+
+    if (username and not auth) or (auth and not username):
+        raise BBJParameterError(
+            "User or Auth was given without the other.")
+
+    elif not username and not auth:
+        return db.anon
+
+    user = db.user_resolve(connection, username)
+    if not user:
+        raise BBJUserError("User %s is not registered" % username)
 
-            username = cherrypy.request.headers.get("User")
-            auth = cherrypy.request.headers.get("Auth")
+    elif auth.lower() != user["auth_hash"].lower():
+        raise BBJException(
+            5, "Invalid authorization key for user.")
 
-            if (username and not auth) or (auth and not username):
-                raise BBJParameterError(
-                    "User or Auth was given without the other.")
+    return user
 
-            elif not username and not auth:
-                user = db.anon
 
+def handle(api, method, read_in, headers):
+    """
+    Call METHOD, an api_method of the API object API, for a request
+    with the body READ_IN (bytes) and HEADERS (a case-insensitive
+    mapping). Returns a tuple of the HTTP status, a dictionary of
+    headers to add to the response and an iterable of the chunks of
+    its serialized body. Big responses are encoded as the chunks are
+    taken, so should be sent as they come.
+    """
+    started = time.perf_counter()
+    timings = {"db": 0.0, "format": 0.0, "serialize": 0.0}
+    function = method.__wrapped__
+    coding = content_coding(headers)
+    response = None
+    chunks = None
+    connection = None
+    error = None
+    status = 200
+    response_headers = {}
+    try:
+        db.sync()
+        connection = pool.get()
+        # read in the body from the request to a string...
+        read_in = str(read_in, "utf8")
+        if not read_in:
+            # the body may be empty, not all methods require input
+            body = {}
+        else:
+            body = json.loads(read_in)
+            if not isinstance(body, dict):
+                raise BBJParameterError("Non-JSONObject input")
+            # lowercase all of its top-level keys
+            body = {key.lower(): value for key, value in body.items()}
+
+        start = time.perf_counter()
+        user = authorize(connection, headers)
+
+        etag = None
+        # the attribute is set on the wrapper, after decoration
+        if hasattr(method, "version"):
+            version = method.version(connection, body)
+            if version is not None:
+                etag = make_etag(function.__name__, body, version)
+
+        if etag and etag in if_none_match(headers):
+            status = 304
+            chunks = []
+            timings["db"] = time.perf_counter() - start
+
+        else:
+            cached = responses.get((etag, coding)) if etag else None
+            if cached is not None:
+                body_coding, serialized = cached
+                chunks = [serialized]
+                timings["db"] = time.perf_counter() - start
             else:
-                user = db.user_resolve(connection, username)
-                if not user:
-                    raise BBJUserError("User %s is not registered" % username)
+                # api_methods may choose to bind a usermap into the thread_data
+                # which will send it off with the response, or a status other
+                # than 200 to send it with. do_formatting() adds up the time
+                # it takes in format_time.
+                cherrypy.thread_data.usermap = {}
+                cherrypy.thread_data.status = 200
+                cherrypy.thread_data.format_time = 0.0
+                try:
+                    value = function(api, body, connection, user)
+                finally:
+                    status = cherrypy.thread_data.status
+                    timings["format"] = cherrypy.thread_data.format_time
+                    timings["db"] = time.perf_counter() - start - timings["format"]
+                start = time.perf_counter()
+                if hasattr(method, "content_type"):
+                    response_headers["Content-Type"] = method.content_type
+                    chunks, body_coding = compress(
+                        [bytes(value, "utf8")], coding)
+                else:
+                    response = schema.response(
+                        value, cherrypy.thread_data.usermap)
+                    if etag:
+                        chunks, body_coding = compress(
+                            [encoder.dumps(response)], coding)
+                        serialized = b"".join(chunks)
+                        responses.put((etag, coding), (body_coding, serialized))
+                        chunks = [serialized]
+                    else:
+                        chunks, body_coding = compress(
+                            encoder.iterencode(response), coding)
+                timings["serialize"] = time.perf_counter() - start
+
+            if body_coding:
+                response_headers["Content-Encoding"] = body_coding
+                # the compressed bytes differ from the uncompressed
+                # ones, so the tag can only be a weak one
+                if etag:
+                    etag = "W/" + etag
+
+        if etag:
+            response_headers["ETag"] = etag
+        if app_config["compress_level"]:
+            response_headers["Vary"] = "Accept-Encoding"
+
+    except BBJException as e:
+        response = e.schema
+
+    except json.JSONDecodeError as e:
+        response = schema.error(0, str(e))
+
+    except Exception as e:
+        response = internal_error(e)
 
-                elif auth.lower() != user["auth_hash"].lower():
-                    raise BBJException(
-                        5, "Invalid authorization key for user.")
+    finally:
+        if connection:
+            pool.put(connection)
+        if chunks is None:
+            response_headers.pop("Content-Type", None)
+            chunks = [encoder.dumps(response)]
+            error = response["error"]["code"]
+        return status, response_headers, measure(
+            function.__name__, status, error, chunks, started, timings)
 
-            # api_methods may choose to bind a usermap into the thread_data
-            # which will send it off with the response
-            cherrypy.thread_data.usermap = {}
-            value = function(self, body, connection, user)
-            response = schema.response(value, cherrypy.thread_data.usermap)
 
-        except BBJException as e:
-            response = e.schema
+def measure(name, status, error, chunks, started, timings):
+    """
+    Yields CHUNKS, the body of the response to a request to the API
+    method NAME that was STARTED at that time.perf_counter(), timing
+    how long each one takes to make. Once the last one is made (or the
+    client goes away), the request is recorded in request_metrics with
+    its HTTP STATUS, ERROR code and the TIMINGS handle() took.
+    """
+    bytes_out = 0
+    chunks = iter(chunks)
+    try:
+        while True:
+            start = time.perf_counter()
+            chunk = next(chunks, None)
+            timings["serialize"] += time.perf_counter() - start
+            if chunk is None:
+                break
+            bytes_out += len(chunk)
+            yield chunk
+    finally:
+        timings["total"] = time.perf_counter() - started
+        request_metrics.record(name, status, error, bytes_out, timings)
 
-        except json.JSONDecodeError as e:
-            response = schema.error(0, str(e))
 
-        except Exception as e:
-            error_id = uuid1().hex
-            response = schema.error(
-                1, "Internal server error: code {} {}".format(
-                    error_id, repr(e)))
-            with open("logs/exceptions/" + error_id, "a") as log:
-                traceback.print_tb(e.__traceback__, file=log)
-                log.write(repr(e))
-            print("logged code 1 exception " + error_id)
+def internal_error(e):
+    """
+    Log the unhandled exception E and return the code 1 error for it.
+    """
+    error_id = uuid1().hex
+    with open("logs/exceptions/" + error_id, "a") as log:
+        traceback.print_tb(e.__traceback__, file=log)
+        log.write(repr(e))
+    print("logged code 1 exception " + error_id)
+    return schema.error(
+        1, "Internal server error: code {} {}".format(error_id, repr(e)))
 
-        finally:
-            connection.close()
-            return json.dumps(response)
 
-    return wrapper
+def content_coding(headers):
+    """
+    Returns the coding to compress the response to a request with
+    HEADERS in: "gzip" or "deflate", whichever the client accepts
+    first, or None when it accepts neither or compression is disabled.
+    """
+    if not app_config["compress_level"]:
+        return None
+    accepted = {}
+    for coding in headers.get("Accept-Encoding", "").split(","):
+        name, _, params = coding.partition(";")
+        params = params.replace(" ", "")
+        try:
+            quality = float(params[2:]) if params.startswith("q=") else 1.0
+        except ValueError:
+            quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for name in ("gzip", "deflate"):
+        if accepted.get(name, accepted.get("*", 0.0)) > 0:
+            return name
+    return None
+
+
+def compress(chunks, coding):
+    """
+    Returns a tuple of an iterable of CHUNKS compressed with CODING
+    and the coding they were compressed with. Bodies smaller than
+    compress_min_size are not worth it, so they are returned as they
+    are and the coding is None. Only the first chunk is taken before
+    returning; the rest are compressed as they are taken.
+    """
+    chunks = iter(chunks)
+    first = next(chunks, b"")
+    chunks = chain((first,), chunks)
+    # streamed responses come in chunks much bigger than the minimum,
+    # so a small first one is the whole body
+    if not coding or len(first) < app_config["compress_min_size"]:
+        return chunks, None
+    return deflate(chunks, coding), coding
+
+
+def deflate(chunks, coding):
+    compressor = zlib.compressobj(
+        app_config["compress_level"], zlib.DEFLATED,
+        # the window size, plus 16 to add the gzip header and trailer
+        zlib.MAX_WBITS | 16 if coding == "gzip" else zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def write(function, database, *args):
+    """
+    Call FUNCTION, one of the functions in db.py which write, with
+    ARGS through the write queue. When it is disabled, DATABASE, the
+    request's connection, is used instead.
+    """
+    if writer:
+        return writer.submit(function, *args)
+    return function(database, *args)
+
+
+def make_etag(name, args, version):
+    """
+    Returns an ETag for the response of the method NAME to ARGS, at VERSION.
+    """
+    key = repr((instance, name, sorted(args.items()), version))
+    return '"%s"' % sha1(bytes(key, "utf8")).hexdigest()
+
+
+def if_none_match(headers):
+    """
+    Returns a list of the ETags the client sent in If-None-Match,
+    without the W/ marking the weak ones.
+    """
+    header = headers.get("If-None-Match", "")
+    tags = [tag.strip() for tag in header.split(",") if tag.strip()]
+    return [tag[2:] if tag.startswith("W/") else tag for tag in tags]
+
+
+def thread_index_version(connection, args):
+    """
+    The version of the thread index. The aggregates catch replies made
+    by other programs, the write counts catch everything done to threads
+    and users by any of the server's processes.
+    """
+    return (
+        connection.execute("""
+            SELECT count(*), max(last_mod), total(reply_count)
+              FROM threads""").fetchone(),
+        db.writes[None],
+        db.user_writes[None]
+    )
+
+
+def thread_load_version(connection, args):
+    """
+    The version of the thread loaded by thread_load, or None when it
+    does not exist (and thread_load will return an error).
+    """
+    thread = connection.execute("""
+        SELECT last_mod, reply_count, pinned FROM threads
+          WHERE thread_id = ?""", (args.get("thread_id"),)).fetchone()
+    if not thread:
+        return None
+    return (thread, db.writes[args["thread_id"]], db.user_writes[None])
 
 
 def create_usermap(connection, obj, index=False):
@@ -122,14 +506,7 @@ def create_usermap(connection, obj, index=False):
     user_set = {item["author"] for item in obj}
     if index:
         [user_set.add(item["last_author"]) for item in obj]
-    return {
-        user_id: db.user_resolve(
-            connection,
-            user_id,
-            externalize=True,
-            return_false=False)
-        for user_id in user_set
-    }
+    return db.user_resolve_many(connection, user_set)
 
 
 def do_formatting(format_spec, messages):
@@ -142,7 +519,11 @@ def do_formatting(format_spec, messages):
     else:
         raise BBJParameterError("invalid formatter specification")
 
+    start = time.perf_counter()
     formatting.apply_formatting(messages, method)
+    cherrypy.thread_data.format_time = \
+        getattr(cherrypy.thread_data, "format_time", 0.0) + \
+        time.perf_counter() - start
     return True
 
 
@@ -248,18 +629,11 @@ class API(object):
         on those requests already contains all the information you will
         need. This endpoint is useful for statistic purposes only.
         """
-        users = {
+        users = [
             user[0] for user in database.execute("SELECT user_id FROM users")
-        }
-        cherrypy.thread_data.usermap = {
-            user: db.user_resolve(
-                database,
-                user,
-                externalize=True,
-                return_false=False)
-            for user in users
-        }
-        return list(users)
+        ]
+        cherrypy.thread_data.usermap = db.user_resolve_many(database, users)
+        return users
     user_map.doctype = "Tools"
     user_map.arglist = (("", ""),)
 
@@ -313,13 +687,23 @@ class API(object):
         Unless you supply `include_op`, these threads have no `messages` parameter.
         If you do, the `messages` parameter is an array with a single message object
         for the original post.
+
+        If you supply `include_summary`, each thread has a `summary` object
+        with the keys `op_preview` and `last_preview`, the start of the bodies
+        of the original post and the last message on a single line and without
+        formatting, and `participants`, the number of users who have posted
+        in it, not counting deleted messages. This is much cheaper for the server than `include_op`.
         """
-        threads = db.thread_index(database, include_op=args.get("include_op"))
+        threads = db.thread_index(
+            database, include_op=args.get("include_op"),
+            include_summary=args.get("include_summary"))
         cherrypy.thread_data.usermap = create_usermap(database, threads, True)
         return threads
+    thread_index.version = thread_index_version
     thread_index.doctype = "Threads & Messages"
     thread_index.arglist = (
         ("OPTIONAL: include_op", "boolean: Include a `messages` object containing the original post"),
+        ("OPTIONAL: include_summary", "boolean: Include a `summary` object with previews of the first and last posts"),
     )
 
     @api_method
@@ -337,7 +721,8 @@ class API(object):
             },
             "messages": [
                 ...standard message object array sorted by date
-            ]
+            ],
+            "next": null // or a cursor value, see below
         }
         ```
 
@@ -350,10 +735,18 @@ class API(object):
         first. The order in the threads object is undefined and you should
         instead use their `last_mod` attribute if you intend to list them
         out visually.
+
+        If you supply `limit`, at most that many messages are returned.
+        When more messages are available, the `next` attribute of the
+        returned object is set to a cursor value; send it back as `before`
+        (with the same `time` and `limit`) to get the next, older page.
+        `next` is null when there is nothing more to fetch. The `threads`
+        object only contains the threads of the messages in the page.
         """
         # XXX: Update with new formatting documentation for arg `format`
         validate(args, ["time"])
-        feed = db.message_feed(database, args["time"])
+        feed = db.message_feed(
+            database, args["time"], args.get("limit"), args.get("before"))
 
         _map = create_usermap(database, feed["messages"])
         _map.update(create_usermap(database, feed["threads"].values(), True))
@@ -364,6 +757,115 @@ class API(object):
     message_feed.doctype = "Threads & Messages"
     message_feed.arglist = (
         ("time", "int/float: epoch/unix time of the earliest point of interest"),
+        ("OPTIONAL: format", "string: the specifier for the desired formatting engine"),
+        ("OPTIONAL: limit", "integer: the maximum number of messages to return"),
+        ("OPTIONAL: before", "array: the `next` cursor from a previous page")
+    )
+
+    @api_method
+    def message_feed_wait(self, args, database, user, **kwargs):
+        """
+        Waits for new activity on the board and returns it as soon as
+        there is some, instead of having to poll `message_feed` over
+        and over. The returned object looks like this:
+
+        ```javascript
+        {
+            "cursor": 1234, // send this back with your next request
+            "missed": false,
+            "threads": {
+                "thread_id": {
+                    // ...thread object
+                },
+                // ...more thread_id/object pairs
+            },
+            "messages": [
+                ...standard message object array sorted by date
+            ],
+            "deleted": [
+                ...thread_ids of threads that were deleted
+            ]
+        }
+        ```
+
+        `messages` holds the new messages as well as the current
+        version of edited and deleted ones, newest first. `threads`
+        holds the current object of every thread that was touched.
+
+        Send the `cursor` from your last response back as `cursor` to
+        get everything that happened since. Without a cursor, this waits
+        for the next activity from now on. If nothing happens within
+        `timeout` seconds (capped by the server), this returns with
+        empty arrays and you can simply ask again.
+
+        The server only remembers a limited amount of recent activity.
+        If `missed` is true, some of it happened too long ago (or before
+        the server restarted) and you should reload with `message_feed`
+        or `thread_index` before waiting again.
+
+        Only a limited number of clients can wait at once. When they are
+        all taken, a code 2 error with HTTP status 503 is returned right
+        away and you should fall back to polling for a while.
+        """
+        if app_config["workers"] > 1:
+            cherrypy.thread_data.status = 503
+            raise BBJException(2,
+                "HTTP error 503: Waiting for activity is not available "
+                "on this instance, poll message_feed instead.")
+
+        cursor = args.get("cursor")
+        timeout = args.get("timeout", app_config["poll_timeout"])
+        if cursor is not None and (
+                not isinstance(cursor, int) or isinstance(cursor, bool)):
+            raise BBJParameterError("cursor must be an integer.")
+        if not isinstance(timeout, (int, float)) or isinstance(timeout, bool):
+            raise BBJParameterError("timeout must be a number.")
+
+        result = db.events.wait(
+            cursor, max(0, min(timeout, app_config["poll_timeout"])))
+        if result is None:
+            cherrypy.thread_data.status = 503
+            raise BBJException(2,
+                "HTTP error 503: Too many clients are waiting for "
+                "activity, try again later.")
+
+        events, missed, cursor = result
+        threads, messages, deleted = dict(), dict(), list()
+        for event in events:
+            thread_id = event["thread_id"]
+            if event["type"] == "delete_thread":
+                deleted.append(thread_id)
+                threads.pop(thread_id, None)
+                continue
+            elif thread_id in deleted:
+                deleted.remove(thread_id)
+            threads[thread_id] = event["thread"]
+            if "message" in event:
+                # later events hold the newer version of a message
+                message = event["message"]
+                messages[(thread_id, message["post_id"])] = dict(message)
+
+        messages = sorted(
+            [message for message in messages.values()
+             if message["thread_id"] in threads],
+            key=lambda message: message["created"], reverse=True)
+
+        _map = create_usermap(database, messages)
+        _map.update(create_usermap(database, threads.values(), True))
+        cherrypy.thread_data.usermap.update(_map)
+
+        do_formatting(args.get("format"), messages)
+        return {
+            "cursor": cursor,
+            "missed": missed,
+            "threads": threads,
+            "messages": messages,
+            "deleted": deleted
+        }
+    message_feed_wait.doctype = "Threads & Messages"
+    message_feed_wait.arglist = (
+        ("OPTIONAL: cursor", "integer: the `cursor` from your last response"),
+        ("OPTIONAL: timeout", "int/float: the most seconds to wait for activity"),
         ("OPTIONAL: format", "string: the specifier for the desired formatting engine")
     )
 
@@ -378,8 +880,8 @@ class API(object):
         """
         no_anon_hook(user)
         validate(args, ["body", "title"])
-        thread = db.thread_create(
-            database, user["user_id"], args["body"],
+        thread = write(
+            db.thread_create, database, user["user_id"], args["body"],
             args["title"], args.get("send_raw"))
         cherrypy.thread_data.usermap = \
             create_usermap(database, thread["messages"])
@@ -402,8 +904,8 @@ class API(object):
         """
         no_anon_hook(user)
         validate(args, ["thread_id", "body"])
-        return db.thread_reply(
-            database, user["user_id"], args["thread_id"],
+        return write(
+            db.thread_reply, database, user["user_id"], args["thread_id"],
             args["body"], args.get("send_raw"))
     thread_reply.doctype = "Threads & Messages"
     thread_reply.arglist = (
@@ -422,22 +924,122 @@ class API(object):
 
         You may also supply the parameter `op_only`. When it's value
         is non-nil, the messages array will only include post_id 0 (the first)
+
+        Long threads can be loaded a page at a time instead. With
+        `after_post_id` and/or `before_post_id`, only the messages
+        whose post_id is between them (exclusive) are included, and
+        `limit` caps how many are returned. To page forward, send the
+        post_id of the last message you have as `after_post_id`. To
+        page backward, send the post_id of the first one as
+        `before_post_id` with a `limit`: you get the `limit` messages
+        just before it. The thread's `reply_count` tells you the
+        post_id of the last message in the thread.
         """
         validate(args, ["thread_id"])
         thread = db.thread_get(
-            database, args["thread_id"], op_only=args.get("op_only"))
+            database, args["thread_id"], op_only=args.get("op_only"),
+            after=args.get("after_post_id"),
+            before=args.get("before_post_id"),
+            limit=args.get("limit"))
         cherrypy.thread_data.usermap = \
             create_usermap(database, thread["messages"])
         do_formatting(args.get("format"), thread["messages"])
         return thread
+    thread_load.version = thread_load_version
     thread_load.doctype = "Threads & Messages"
     thread_load.arglist = (
         ("thread_id", "string: the thread to load."),
         ("OPTIONAL: op_only", "boolean: include only the original message in `messages`"),
         # XXX formal formatting documentation is desperately needed
+        ("OPTIONAL: format", "string: the formatting type of the returned messages."),
+        ("OPTIONAL: after_post_id", "int: include only messages after this post_id."),
+        ("OPTIONAL: before_post_id", "int: include only messages before this post_id."),
+        ("OPTIONAL: limit", "int: the maximum number of messages to include.")
+    )
+
+    @api_method
+    def thread_updates(self, args, database, user, **kwargs):
+        """
+        Returns what changed in a thread since you loaded it, so it can
+        be refreshed without loading the whole thing again. Requires the
+        arguments `thread_id` and `after_post_id`, the post_id of the last
+        message you have. The returned object looks like this:
+
+        ```javascript
+        {
+            "thread": {
+                // ...thread object, without `messages`
+            },
+            "messages": [
+                ...standard message object array sorted by post_id
+            ],
+            "time": 1234567890.123 // send this back as `since`
+        }
+        ```
+
+        `messages` holds every message whose post_id is greater than
+        `after_post_id`. If you also supply `since`, it holds the
+        messages edited or deleted after that time as well. Use the
+        `time` from your last response for `since`. After a
+        `thread_load`, use the `last_mod` of the thread instead: edits
+        made since then are included, even though some of them may
+        already have been in what you loaded.
+
+        `format` may be specified like for `thread_load`.
+        """
+        validate(args, ["thread_id", "after_post_id"])
+        updates = db.thread_updates(
+            database, args["thread_id"],
+            args["after_post_id"], args.get("since"))
+        cherrypy.thread_data.usermap = \
+            create_usermap(database, updates["messages"])
+        cherrypy.thread_data.usermap.update(
+            create_usermap(database, [updates["thread"]], True))
+        do_formatting(args.get("format"), updates["messages"])
+        return updates
+    thread_updates.doctype = "Threads & Messages"
+    thread_updates.arglist = (
+        ("thread_id", "string: the thread to load."),
+        ("after_post_id", "int: the post_id of the last message you have."),
+        ("OPTIONAL: since", "int/float: the `time` of the last update, or the thread's `last_mod`."),
         ("OPTIONAL: format", "string: the formatting type of the returned messages.")
     )
 
+    @api_method
+    def search(self, args, database, user, **kwargs):
+        """
+        Requires the argument `query`. Searches the bodies of all messages
+        and the titles of all threads for the words in `query`, and returns
+        an object with the best matching messages first:
+
+        {
+          "hits": [...hit objects],
+          "next": null or the `offset` of the next page of hits
+        }
+
+        Every word must occur in a message for it to match. A word ending
+        with `*` matches any word starting with it. There is no other
+        query syntax. A match in the title of a thread is a hit on its OP.
+
+        Each hit has the `thread_id`, `post_id`, `author` and `created`
+        of the message, the `title` of its thread, and a `snippet` of its
+        text around the match. The snippet is unformatted, and is an array
+        in the same form as a line of sequential formatting, with the
+        matched words marked "match": [[null, "text"], ["match", "word"]]
+        """
+        validate(args, ["query"])
+        results = db.search(
+            database, args["query"],
+            args.get("limit", 20), args.get("offset", 0))
+        cherrypy.thread_data.usermap = create_usermap(database, results["hits"])
+        return results
+    search.doctype = "Threads & Messages"
+    search.arglist = (
+        ("query", "string: the words to search for."),
+        ("OPTIONAL: limit", "int: the most hits to return, 20 by default and 100 at most."),
+        ("OPTIONAL: offset", "int: the `next` of the previous page.")
+    )
+
     @api_method
     def edit_post(self, args, database, user, **kwargs):
         """
@@ -460,8 +1062,8 @@ class API(object):
         """
         no_anon_hook(user, "Anons cannot edit messages.")
         validate(args, ["body", "thread_id", "post_id"])
-        return db.message_edit_commit(
-            database, user["user_id"], args["thread_id"],
+        return write(
+            db.message_edit_commit, database, user, args["thread_id"],
             args["post_id"], args["body"], args.get("send_raw"))
     edit_post.doctype = "Threads & Messages"
     edit_post.arglist = (
@@ -487,8 +1089,9 @@ class API(object):
         """
         no_anon_hook(user, "Anons cannot delete messages.")
         validate(args, ["thread_id", "post_id"])
-        return db.message_delete(
-            database, user["user_id"], args["thread_id"], args["post_id"])
+        return write(
+            db.message_delete, database, user,
+            args["thread_id"], args["post_id"])
     delete_post.doctype = "Threads & Messages"
     delete_post.arglist = (
         ("thread_id", "string: the id of the thread this message was posted in."),
@@ -514,8 +1117,8 @@ class API(object):
         """
         no_anon_hook(user, "Anons cannot edit messages.")
         validate(args, ["value", "thread_id", "post_id"])
-        return db.message_edit_commit(
-            database, user["user_id"],
+        return write(
+            db.message_edit_commit, database, user,
             args["thread_id"], args["post_id"],
             None, args["value"], None)
     set_post_raw.doctype = "Threads & Messages"
@@ -553,7 +1156,7 @@ class API(object):
         no_anon_hook(user, "Anons cannot edit messages.")
         validate(args, ["thread_id", "post_id"])
         return db.message_edit_query(
-            database, user["user_id"], args["thread_id"], args["post_id"])
+            database, user, args["thread_id"], args["post_id"])
     edit_query.doctype = "Threads & Messages"
     edit_query.arglist = (
         ("thread_id", "string: the id of the thread the message was posted in."),
@@ -641,6 +1244,139 @@ class API(object):
          "response instead of a special object.")
     )
 
+    @api_method
+    def metrics(self, args, database, user, **kwargs):
+        """
+        Requires no arguments. Returns, as plain text in the Prometheus
+        exposition format rather than JSON, how many requests have been
+        made to each endpoint, their HTTP statuses and error codes, the
+        bytes sent in answer and histograms of how long they took, from
+        start to finish and in each phase: `db` (running the endpoint),
+        `format` (running messages through a formatter) and `serialize`
+        (encoding and compressing the response). Then come the hit
+        counts of the caches, the write queue's counts and the database
+        connections open. Errors are still returned as JSON.
+
+        This method requires that the caller is logged in and has admin
+        status on their account. When the server runs several worker
+        processes, only the one that answered is reported on.
+        """
+        if not user["is_admin"]:
+            raise BBJUserError("Only admins can read metrics")
+        return request_metrics.render(server_metrics())
+    metrics.doctype = "Tools"
+    metrics.arglist = (("", ""),)
+    metrics.content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+    @api_method
+    def batch(self, args, database, user, **kwargs):
+        """
+        Requires the argument `calls`, an array of objects that each
+        have a `method`, the name of another endpoint, and optionally
+        the `args` to send to it. The calls are made one after another
+        as the sender of this request, saving a round trip to the
+        server for each one. `batch` itself, `message_feed_wait` and
+        `metrics` can't be called this way.
+
+        Returns an array of the response objects of each call, in
+        order, just as the endpoints would have returned them on their
+        own, except that their usermaps are empty: the users of all of
+        them are merged into the usermap of this response instead.
+
+        A call that fails does not stop the ones after it, and does not
+        undo the ones before it; check the `error` of each response.
+
+        The calls are not made in one transaction: each one that writes
+        is committed on its own, just as it would be if it were sent by
+        itself. Posts and edits go through the server's write queue,
+        which commits them along with the writes of other requests, and
+        holding it for the whole of a batch (reads and all) would hold
+        up every other poster behind it.
+        """
+        validate(args, ["calls"])
+        if not isinstance(args["calls"], list):
+            raise BBJParameterError("calls must be an array.")
+
+        usermap = {}
+        results = []
+        for call in args["calls"]:
+            cherrypy.thread_data.usermap = {}
+            try:
+                if not isinstance(call, dict) or "method" not in call:
+                    raise BBJParameterError(
+                        "Each call must be an object with a method.")
+                method = getattr(self, str(call["method"]), None)
+                if not getattr(method, "exposed", False) \
+                        or method.__name__ in ("batch", "message_feed_wait") \
+                        or hasattr(method, "content_type"):
+                    raise BBJParameterError(
+                        "Method {} can't be batched.".format(call["method"]))
+                call_args = call.get("args") or {}
+                if not isinstance(call_args, dict):
+                    raise BBJParameterError("args must be an object.")
+                call_args = {key.lower(): value for key, value in call_args.items()}
+                value = method.__wrapped__(self, call_args, database, user)
+                results.append(schema.response(value))
+                usermap.update(cherrypy.thread_data.usermap)
+            except BBJException as e:
+                results.append(e.schema)
+            except Exception as e:
+                results.append(internal_error(e))
+            finally:
+                # the calls which write on the request's connection (user
+                # and pin changes, and posts when the write queue is off)
+                # must not leave a failed write for the next one to commit
+                if database.in_transaction:
+                    database.rollback()
+
+        cherrypy.thread_data.usermap = usermap
+        return results
+    batch.doctype = "Tools"
+    batch.arglist = (
+        ("calls", "array: objects with a `method` (string) and optionally "
+         "its `args` (object)"),
+    )
+
+
+def server_metrics():
+    """
+    The metrics the metrics endpoint reports along with the requests,
+    in the form Metrics.render() takes them.
+    """
+    caches = {
+        "users": db.user_cache.stats(),
+        "formatting": formatting.cache.stats(),
+        "responses": responses.stats()
+    }
+    others = [
+        ("bbj_cache_" + name, type, help,
+         {(("cache", cache),): stats[stat] for cache, stats in caches.items()})
+        for stat, name, type, help in (
+            ("entries", "entries", "gauge", "Entries in each cache."),
+            ("size", "size", "gauge", "The most entries each cache may hold."),
+            ("hits", "hits_total", "counter", "Lookups found in each cache."),
+            ("misses", "misses_total", "counter", "Lookups missed by each cache."))
+    ]
+    others.append(
+        ("bbj_db_connections", "gauge", "Database connections open in the pool.",
+         {(): pool.opened}))
+    if writer:
+        stats = writer.stats()
+        others.extend(
+            ("bbj_write_queue_" + name, type, help, {(): stats[stat]})
+            for stat, name, type, help in (
+                ("queued", "queued", "gauge", "Writes waiting for the writer."),
+                ("deepest_queue", "deepest", "gauge",
+                 "The most writes that have waited at once."),
+                ("writes", "writes_total", "counter", "Writes made."),
+                ("failures", "failures_total", "counter", "Writes that failed."),
+                ("batches", "batches_total", "counter", "Batches committed."),
+                ("largest_batch", "largest_batch", "gauge",
+                 "The most writes committed at once."),
+                ("mean_batch", "mean_batch", "gauge",
+                 "The mean number of writes committed at once.")))
+    return others
+
 
 def api_http_error(status, message, traceback, version):
     return json.dumps(schema.error(
@@ -654,11 +1390,137 @@ API_CONFIG = {
 }
 
 
+def async_handler(method, path, read_in, headers):
+    """
+    Handle a request from the asyncio engine with the API method for
+    PATH, the same way CherryPy would.
+    """
+    path = path.partition("?")[0]
+    endpoint = None
+    if path.startswith("/api/"):
+        endpoint = getattr(api, path[len("/api/"):].strip("/"), None)
+    if not getattr(endpoint, "exposed", False):
+        return 404, {}, [bytes(api_http_error(
+            "404 Not Found", "The path '%s' was not found." % path, None, None),
+            "utf8")]
+    return handle(api, endpoint, read_in if method == "POST" else b"", headers)
+
+
+def check_user(headers):
+    connection = pool.get()
+    try:
+        authorize(connection, headers)
+    finally:
+        pool.put(connection)
+
+
+async def park_waiter(method, path, read_in, headers):
+    """
+    Park message_feed_wait requests on the event loop until there is
+    activity for them, then pass them on to be answered right away.
+    Anything that isn't a well formed request to wait is passed on as
+    it is, and gets its error (or response) from the API method.
+    """
+    global parked
+    if app_config["workers"] > 1 or method != "POST" or \
+            path.partition("?")[0].strip("/") != "api/message_feed_wait":
+        return read_in
+    try:
+        body = {key.lower(): value for key, value
+                in json.loads(str(read_in, "utf8") or "{}").items()}
+    except (ValueError, AttributeError):
+        return read_in
+    cursor = body.get("cursor")
+    timeout = body.get("timeout", app_config["poll_timeout"])
+    if cursor is not None and (
+            not isinstance(cursor, int) or isinstance(cursor, bool)):
+        return read_in
+    if not isinstance(timeout, (int, float)) or isinstance(timeout, bool):
+        return read_in
+    timeout = max(0, min(timeout, app_config["poll_timeout"]))
+    if cursor is None:
+        cursor = db.events.cursor
+
+    if cursor == db.events.cursor and timeout > 0:
+        # a full house is passed on as it is, and db.events turns it away
+        if parked >= app_config["poll_max_waiters"]:
+            return read_in
+        try:
+            # don't make a client wait out the timeout to learn its
+            # credentials are wrong
+            await engine.run_in_worker(check_user, headers)
+        except BBJException:
+            return read_in
+        parked += 1
+        try:
+            deadline = engine.loop.time() + timeout
+            while db.events.cursor == cursor:
+                remaining = deadline - engine.loop.time()
+                if remaining <= 0 or not await activity.wait(remaining):
+                    break
+        finally:
+            parked -= 1
+
+    body.update(cursor=cursor, timeout=0)
+    return bytes(json.dumps(body), "utf8")
+
+
+async def start_async():
+    global activity
+    activity = Notifier(engine.loop)
+    db.events.listen(activity.notify)
+    if app_config["db_checkpoint_interval"]:
+        engine.loop.create_task(checkpoints(app_config["db_checkpoint_interval"]))
+
+
+async def checkpoints(interval):
+    """
+    The asyncio engine's counterpart to the WAL checkpoint Monitor.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await engine.run_in_worker(pool.checkpoint)
+        except Exception as e:
+            print("WAL checkpoint failed: " + repr(e))
+
+
+def waiting_room():
+    """
+    The number of message_feed_wait requests that may hold a request
+    thread and a database connection while they wait. See the comment
+    on poll_max_waiters above.
+    """
+    if app_config["engine"] == "asyncio" or app_config["workers"] > 1:
+        return 0
+    return app_config["poll_max_waiters"]
+
+
 def run():
+    global pool, api
+    if app_config["engine"] not in ("cherrypy", "asyncio"):
+        exit("Unknown engine %r, use cherrypy or asyncio." % app_config["engine"])
+    waiters = waiting_room()
+    pool = ConnectionPool(
+        dbname,
+        app_config["db_pool_size"] and app_config["db_pool_size"] + waiters,
+        app_config["db_pool_timeout"],
+        app_config["db_pragmas"].items())
+    db.events = EventLog(app_config["event_log_size"], waiters)
+    try:
+        encoder.use(app_config["json_encoder"])
+    except ValueError as e:
+        exit(str(e))
+    db.user_cache.resize(app_config["user_cache_size"])
+    db.user_cache.ttl = app_config["user_cache_ttl"]
+    formatting.cache.resize(app_config["format_cache_size"])
+    responses.resize(app_config["response_cache_size"])
     # user anonymity is achieved in the laziest possible way: a literal user
     # named anonymous. may god have mercy on my soul.
-    _c = sqlite3.connect(dbname)
+    _c = pool.get()
     try:
+        if migrations.outdated(_c):
+            exit("The database is out of date, run dbupdate.py to upgrade it.")
         db.anon = db.user_resolve(_c, "anonymous")
         if not db.anon:
             db.anon = db.user_register(
@@ -666,8 +1528,112 @@ def run():
                 "5430eeed859cad61d925097ec4f53246"
                 "1ccf1ab6b9802b09a313be1478a4d614")
     finally:
-        _c.close()
-    cherrypy.quickstart(API(), "/api", API_CONFIG)
+        pool.put(_c)
+
+    api = API()
+    if app_config["workers"] > 1:
+        # SQLite connections must not be used across a fork, the
+        # workers each open their own
+        pool.close()
+        listener = socket.create_server((
+            cherrypy.config["server.socket_host"],
+            cherrypy.config["server.socket_port"]),
+            backlog=cherrypy.server.socket_queue_size)
+        prefork(app_config["workers"], lambda: serve(listener))
+    else:
+        serve()
+
+
+def serve(listener=None):
+    """
+    Serve the API from this process with the configured engine, on the
+    listening socket LISTENER if given instead of the configured host
+    and port.
+    """
+    global engine, writer
+    if app_config["write_queue_size"]:
+        writer = WriteQueue(
+            pool.connect, app_config["write_queue_size"],
+            app_config["db_pool_timeout"], app_config["write_batch_size"],
+            app_config["write_batch_delay"])
+        writer.start()
+
+    if app_config["engine"] == "asyncio":
+        engine = AsyncServer(
+            async_handler, app_config["thread_pool"], park_waiter,
+            lambda status: api_http_error(
+                "%d %s" % (status, status.phrase), status.description,
+                None, None))
+        engine.run(
+            cherrypy.config["server.socket_host"],
+            cherrypy.config["server.socket_port"],
+            start_async, listener)
+        return
+
+    cherrypy.config.update({
+        "server.thread_pool": app_config["thread_pool"] + waiting_room()
+    })
+    if listener:
+        # cheroot serves on file descriptor 3 when this is set, the
+        # way systemd hands a socket over to a service
+        os.dup2(listener.fileno(), 3)
+        os.environ["LISTEN_PID"] = str(os.getpid())
+    if app_config["db_checkpoint_interval"]:
+        Monitor(
+            cherrypy.engine, pool.checkpoint,
+            frequency=app_config["db_checkpoint_interval"],
+            name="WAL checkpoint").subscribe()
+    cherrypy.quickstart(api, "/api", API_CONFIG)
+
+
+def prefork(count, serve):
+    """
+    Fork COUNT worker processes which each call SERVE, and start a new
+    one whenever one dies, until this process is interrupted or
+    terminated. Then the workers are terminated as well.
+    """
+    workers = set()
+
+    def spawn():
+        pid = os.fork()
+        if pid:
+            workers.add(pid)
+            return
+        status = 1
+        try:
+            serve()
+            status = 0
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+
+    def terminate(*_):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, terminate)
+    for _ in range(count):
+        spawn()
+    try:
+        while True:
+            pid, status = os.wait()
+            workers.discard(pid)
+            print("worker %d exited (status %d), starting another" % (pid, status))
+            time.sleep(1)
+            spawn()
+    except KeyboardInterrupt:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in workers:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
 
 
 def get_arg(key, default, get_value=True):
@@ -685,6 +1651,8 @@ if __name__ == "__main__":
     port = get_arg("port", app_config["port"])
     host = get_arg("host", app_config["host"])
     debug = get_arg("debug", app_config["debug"], False)
+    app_config["engine"] = get_arg("engine", app_config["engine"])
+    app_config["workers"] = int(get_arg("workers", app_config["workers"]))
     cherrypy.config.update({
         "server.socket_port": int(port),
         "server.socket_host": host
@@ -0,0 +1,235 @@
+"""
+A small HTTP server built on asyncio, which server.py can run the API on
+instead of CherryPy (see the `engine` option in config.json).
+
+The API methods block on SQLite, so they are still run on a fixed pool
+of worker threads. Everything else happens on the event loop: reading
+requests, writing responses and keeping connections open between them.
+An idle keep-alive connection, or a request parked while it waits for
+activity (see Notifier), costs no thread at all, so thousands of clients
+can wait on message_feed_wait with only a handful of workers.
+
+Only as much of HTTP/1.1 as the clients need is implemented: keep-alive
+and request bodies with a Content-Length. Anything else is refused.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from http.client import parse_headers
+from http import HTTPStatus
+from io import BytesIO
+import asyncio
+
+
+class Notifier(object):
+    """
+    Lets coroutines on LOOP wait until notify() is called, which
+    may be done from any thread.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.event = asyncio.Event()
+
+
+    def notify(self):
+        self.loop.call_soon_threadsafe(self.wake)
+
+
+    def wake(self):
+        event, self.event = self.event, asyncio.Event()
+        event.set()
+
+
+    async def wait(self, timeout):
+        """
+        Wait for the next notify() for up to TIMEOUT seconds. Returns
+        False if it timed out.
+        """
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+class AsyncServer(object):
+    """
+    Serves requests by calling HANDLER(method, path, body, headers) on
+    one of WORKERS threads. It must return a tuple of the HTTP status,
+    a dictionary of headers and an iterable of the chunks (bytes) of
+    the body. A body of more than one chunk is sent with chunked
+    encoding as the chunks are made, each on a worker thread.
+
+    PARK, if given, is a coroutine called with the same arguments on
+    the event loop before HANDLER. It may wait as long as it likes and
+    returns the body to pass on to HANDLER.
+
+    ERROR_PAGE, if given, is called with an HTTPStatus to make the body
+    (a string) sent along with it when a request is refused.
+
+    A connection that sends nothing for IDLE_TIMEOUT seconds is closed.
+    """
+    def __init__(self, handler, workers=10, park=None, error_page=None,
+                 idle_timeout=60, max_body=16777216):
+        self.handler = handler
+        self.park = park
+        self.error_page = error_page
+        self.idle_timeout = idle_timeout
+        self.max_body = max_body
+        self.executor = ThreadPoolExecutor(
+            workers, thread_name_prefix="bbj-worker")
+        self.loop = None
+
+
+    def run_in_worker(self, function, *args):
+        return self.loop.run_in_executor(self.executor, function, *args)
+
+
+    async def read_request(self, reader):
+        """
+        Returns a tuple of the method, path, HTTP version, headers
+        and body of the next request, or None if the client is done.
+        Raises ValueError for requests that can't be handled.
+        """
+        try:
+            head = await asyncio.wait_for(
+                reader.readuntil(b"\r\n\r\n"), self.idle_timeout)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+            return None
+        except asyncio.LimitOverrunError:
+            raise ValueError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+
+        line, _, rest = head.partition(b"\r\n")
+        try:
+            method, path, version = str(line, "latin-1").split()
+        except ValueError:
+            raise ValueError(HTTPStatus.BAD_REQUEST)
+        headers = parse_headers(BytesIO(rest))
+
+        if "chunked" in headers.get("Transfer-Encoding", "").lower():
+            raise ValueError(HTTPStatus.LENGTH_REQUIRED)
+        try:
+            length = int(headers.get("Content-Length", 0))
+        except ValueError:
+            raise ValueError(HTTPStatus.BAD_REQUEST)
+        if length > self.max_body:
+            raise ValueError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        body = await reader.readexactly(length) if length else b""
+        return method, path, version, headers, body
+
+
+    def respond(self, method, path, body, headers, chunked):
+        """
+        Call the handler and take the first chunk of its response. The
+        rest is returned as an iterator if there is any, or joined onto
+        the first chunk when CHUNKED encoding can't be used.
+        """
+        status, headers, chunks = self.handler(method, path, body, headers)
+        chunks = iter(chunks)
+        first = next(chunks, b"")
+        second = next(chunks, None)
+        if second is None:
+            return status, headers, first, None
+        elif not chunked:
+            return status, headers, b"".join(chain((first, second), chunks)), None
+        return status, headers, first, chain((second,), chunks)
+
+
+    def write_head(self, writer, status, headers, keep_alive, length=None):
+        """
+        Write the status line and HEADERS, with the Content-Length
+        LENGTH or, when that is None, for a chunked body.
+        """
+        status = HTTPStatus(status)
+        lines = ["HTTP/1.1 %d %s" % (status, status.phrase)]
+        headers = dict(headers)
+        headers.setdefault("Content-Type", "application/json")
+        if length is None:
+            headers["Transfer-Encoding"] = "chunked"
+        else:
+            headers["Content-Length"] = str(length)
+        headers["Connection"] = "keep-alive" if keep_alive else "close"
+        lines.extend("%s: %s" % item for item in headers.items())
+        writer.write(bytes("\r\n".join(lines) + "\r\n\r\n", "latin-1"))
+
+
+    def write_chunk(self, writer, chunk):
+        writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+
+
+    async def connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await self.read_request(reader)
+                except ValueError as e:
+                    status, = e.args
+                    body = self.error_page(status) if self.error_page else ""
+                    body = bytes(body, "utf8")
+                    self.write_head(writer, status, {}, False, len(body))
+                    writer.write(body)
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+
+                method, path, version, headers, body = request
+                connection = headers.get("Connection", "").lower()
+                if version == "HTTP/1.1":
+                    keep_alive = connection != "close"
+                else:
+                    keep_alive = connection == "keep-alive"
+
+                if self.park:
+                    body = await self.park(method, path, body, headers)
+                status, response_headers, first, rest = \
+                    await self.run_in_worker(
+                        self.respond, method, path, body, headers,
+                        version == "HTTP/1.1")
+
+                if rest is None:
+                    self.write_head(
+                        writer, status, response_headers, keep_alive, len(first))
+                    writer.write(first)
+                else:
+                    self.write_head(writer, status, response_headers, keep_alive)
+                    chunk = first
+                    while chunk is not None:
+                        if chunk:
+                            self.write_chunk(writer, chunk)
+                            await writer.drain()
+                        chunk = await self.run_in_worker(next, rest, None)
+                    writer.write(b"0\r\n\r\n")
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+    async def serve(self, host, port, startup=None, sock=None):
+        """
+        Serve on HOST and PORT, or on the listening socket SOCK instead,
+        until cancelled. STARTUP, if given, is a coroutine function
+        awaited once the loop is running.
+        """
+        self.loop = asyncio.get_running_loop()
+        if startup:
+            await startup()
+        if sock:
+            host = port = None
+        server = await asyncio.start_server(
+            self.connection, host, port, sock=sock)
+        async with server:
+            await server.serve_forever()
+
+
+    def run(self, host, port, startup=None, sock=None):
+        try:
+            asyncio.run(self.serve(host, port, startup, sock))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.executor.shutdown(wait=False)
@@ -0,0 +1,134 @@
+"""
+In-process caches for data that is read far more often than it is
+written. Every cache is bounded in size, evicting the least recently
+used entries first, and counts its hits and misses. Entries may also be
+given a time to live, for data that can be changed behind the server's
+back.
+
+The caches are shared by all the request threads. To keep a value read
+from the database from being cached after a concurrent write has already
+invalidated it, take the generation before reading and pass it to put():
+an invalidation in the meantime bumps the generation and the put is
+dropped.
+
+They are not shared between processes. When the server runs several
+worker processes, each one counts its writes in SharedCounters, and the
+others compare the counts against what they saw last to find out their
+caches are out of date.
+"""
+
+from collections import OrderedDict
+from multiprocessing import RawArray, Lock as ProcessLock
+from threading import Lock
+from time import monotonic
+from zlib import crc32
+
+
+class LRUCache(object):
+    """
+    A mapping of at most SIZE keys. A SIZE of 0 disables the cache:
+    nothing is stored and every get() is a miss. When TTL is given,
+    entries expire TTL seconds after they are put.
+    """
+    def __init__(self, size=1000, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, expires = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and monotonic() >= expires:
+                del self.data[key]
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+
+    def put(self, key, value, generation=None):
+        """
+        Store VALUE under KEY, unless GENERATION is given and the
+        cache has been invalidated since it was taken.
+        """
+        with self.lock:
+            if not self.size:
+                return
+            if generation is not None and generation != self.generation:
+                return
+            expires = monotonic() + self.ttl if self.ttl else None
+            self.data[key] = (value, expires)
+            self.data.move_to_end(key)
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+
+    def invalidate(self, *keys):
+        """
+        Remove KEYS from the cache, or everything when no keys are given.
+        """
+        with self.lock:
+            self.generation += 1
+            if not keys:
+                self.data.clear()
+            for key in keys:
+                self.data.pop(key, None)
+
+
+    def resize(self, size):
+        with self.lock:
+            self.size = size
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+
+    def stats(self):
+        """
+        Returns a dictionary with the size, hit and miss counts
+        and the hit rate of the cache.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.data),
+                "size": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+
+class SharedCounters(object):
+    """
+    Write counters kept in memory shared with every process forked after
+    they are made. Any key can be counted, but the keys are hashed into
+    SLOTS counters, so some share one. A key's count goes up whenever it
+    is written to, and now and then when another one is.
+    """
+    def __init__(self, slots=4096):
+        self.slots = slots
+        self.counts = RawArray("Q", slots)
+        self.lock = ProcessLock()
+
+
+    def slot(self, key):
+        return crc32(bytes(repr(key), "utf8")) % self.slots
+
+
+    def __getitem__(self, key):
+        return self.counts[self.slot(key)]
+
+
+    def increment(self, key):
+        with self.lock:
+            self.counts[self.slot(key)] += 1
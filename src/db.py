@@ -5,9 +5,8 @@ an argument to all the functions and is maintained by CherryPy's threading
 system. This is clunky but fuck it, it works (for now at least).
 
 All post and thread data are stored in the database without formatting.
-This is questionable, as it causes formatting to be reapplied with each
-pull for the database. Im debating whether posts should be stored in all
-4 formats, or if maybe a caching system should be used.
+Formatted bodies are cached in memory instead (see formatting.cache), and
+the functions here which change a message body drop its cached output.
 
 The database, nor ANY part of the server, DOES NOT HANDLE PASSWORD HASHING!
 Clients are responsible for creation of hashes and passwords should never
@@ -21,17 +20,91 @@ use of sha256.
 # incoming requests and re-resolving them from their ID is wasteful.
 
 from src.exceptions import BBJParameterError, BBJUserError
-from src.utils import ordered_keys, schema_values
-from src import schema
+from src.utils import ordered_keys, schema_values, preview
+from src.events import EventLog
+from src.cache import LRUCache, SharedCounters
+from src import schema, formatting
+from threading import local, Lock
 from uuid import uuid1
 from time import time
 import json
 import os
+import re
 
 anon = None
 
+# internal user objects, keyed by both their user_id and user_name. The
+# server sets its size and time to live from the config: the writes made
+# by the server drop users from it right away, but the ones made to the
+# database by hand (there is no endpoint for making admins) are only seen
+# once they expire. Objects are copied on the way out, so callers can
+# modify what user_resolve returns.
+user_cache = LRUCache(1000, ttl=10)
+
+# the number of writes made to each thread, and to the board as a whole
+# under the key None, by every worker process of the server. Edits,
+# deletions and pins do not show in a thread's last_mod or reply_count,
+# so the versions the server builds its ETags from include these counts
+# as well.
+writes = SharedCounters()
+
+# the number of writes made to users by every worker process, and the
+# count this one last cleared its user_cache at (see sync). Both are
+# changed together under user_writes_lock, or sync() could see the
+# shared count of a write of this process before it is counted as seen.
+user_writes = SharedCounters(1)
+user_writes_seen = 0
+user_writes_lock = Lock()
+
+# recent activity for the clients waiting on it, see events.py. The
+# server replaces this with one sized from its config.
+events = EventLog()
+
+# while the write queue writes a batch, its thread holds the bumps of the
+# writes in held.bumps and makes them once the batch commits (see writer.py)
+held = local()
+
+
+def bump(thread_id, event, **details):
+    """
+    Count a committed write to THREAD_ID and publish it as an EVENT,
+    one of "reply", "edit", "pin" or "delete_thread", with DETAILS.
+    """
+    bumps = getattr(held, "bumps", None)
+    if bumps is not None:
+        bumps.append((thread_id, event, details))
+        return
+    writes.increment(thread_id)
+    writes.increment(None)
+    events.publish(type=event, thread_id=thread_id, **details)
+
+
+def user_written():
+    """
+    Count a committed write to a user. This process has already dropped
+    the user from its own cache, so it does not clear it in sync().
+    """
+    global user_writes_seen
+    with user_writes_lock:
+        user_writes.increment(None)
+        user_writes_seen += 1
+
 
-def message_feed(connection, time):
+def sync():
+    """
+    Catch up with the writes made by other worker processes. They may
+    have changed any user, so the user_cache is cleared when they wrote
+    to one. Called at the start of every request.
+    """
+    global user_writes_seen
+    with user_writes_lock:
+        count = user_writes[None]
+        if count != user_writes_seen:
+            user_writes_seen = count
+            user_cache.invalidate()
+
+
+def message_feed(connection, time, limit=None, before=None):
     """
     Returns a special object representing all activity on the board since
     the argument `time`, a unix/epoch timestamp.
@@ -43,7 +116,8 @@ def message_feed(connection, time):
             },
             ...more thread_id/object pairs
         },
-        "messages": [...standard message object array sorted by date]
+        "messages": [...standard message object array sorted by date],
+        "next": null or a cursor for the next page
     }
 
     The message objects in "messages" are the same objects returned
@@ -55,38 +129,87 @@ def message_feed(connection, time):
     first. The order in the threads object is undefined and you should
     instead use their `last_mod` attribute if you intend to list them
     out visually.
-    """
-    threads = {
-        obj[0]: schema.thread(*obj) for obj in
-            connection.execute(
-                "SELECT * FROM threads WHERE last_mod > ?", (time,))
-    }
 
-    messages = list()
-    for thread in threads.values():
-        messages += [
-            schema.message(*obj) for obj in
-                connection.execute("""
-                SELECT * FROM messages WHERE thread_id = ?
-                    AND created > ? """, (thread["thread_id"], time))
-        ]
+    LIMIT caps the number of messages returned. When there are more
+    messages than that, "next" is set to a cursor which can be passed
+    back in as BEFORE to get the next (older) page. Otherwise, "next"
+    is None. "threads" only contains the threads of the returned messages.
+    """
+    if limit is not None:
+        if not isinstance(limit, int) or isinstance(limit, bool) or limit < 1:
+            raise BBJParameterError("limit must be a positive integer.")
+
+    query = """
+        SELECT messages.*, threads.* FROM messages
+          JOIN threads ON threads.thread_id = messages.thread_id
+          WHERE messages.created > ? %s
+          ORDER BY messages.created DESC,
+                   messages.thread_id DESC,
+                   messages.post_id DESC %s"""
+    params = [time]
+    if before is not None:
+        # the cursor is [created, thread_id, post_id] of the last message
+        # sent, so messages sharing a timestamp are never skipped
+        if not isinstance(before, list) or len(before) != 3:
+            raise BBJParameterError("before must be a cursor from a previous page.")
+        params.extend(before)
+    if limit is not None:
+        # fetch one extra row to know if there is another page
+        params.append(limit + 1)
+
+    rows = connection.execute(query % (
+        "AND (messages.created, messages.thread_id, messages.post_id) < (?,?,?)"
+            if before is not None else "",
+        "LIMIT ?" if limit is not None else ""
+    ), params).fetchall()
+
+    cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        cursor = [rows[-1][3], rows[-1][0], rows[-1][1]]
+
+    threads, messages = dict(), list()
+    for obj in rows:
+        # the first 8 columns are the message, the rest are its thread
+        messages.append(schema.message(*obj[:8]))
+        if obj[0] not in threads:
+            threads[obj[0]] = schema.thread(*obj[8:])
 
     return {
         "threads": threads,
-        "messages": sorted(messages, key=lambda m: m["created"], reverse=True)
+        "messages": messages,
+        "next": cursor
     }
 
 
 ### THREADS ###
 
-def thread_get(connection, thread_id, messages=True, op_only=False):
+def thread_get(connection, thread_id, messages=True, op_only=False,
+               after=None, before=None, limit=None):
     """
     Fetch the thread_id from the database. Formatting is be handled
     elsewhere.
 
     MESSAGES, if False, will omit the inclusion of a thread's messages
     and only get its metadata, such as title, author, etc.
+
+    AFTER, BEFORE and LIMIT load only a range of the messages: those
+    with a post_id greater than AFTER and less than BEFORE, at most LIMIT
+    of them. When LIMIT is given with BEFORE but not AFTER, the page ends
+    at BEFORE instead of starting at the beginning of the thread. The
+    messages are always in post_id order, so for a full thread each
+    post_id matches its list[index] and for a range they are offset by
+    the post_id of the first one.
     """
+    for name, value, least in (
+            ("after_post_id", after, 0),
+            ("before_post_id", before, 0),
+            ("limit", limit, 1)):
+        if value is not None and (
+                not isinstance(value, int) or isinstance(value, bool) or value < least):
+            raise BBJParameterError("{} must be {} integer.".format(
+                name, "a positive" if least else "a non-negative"))
+
     c = connection.cursor()
     thread = c.execute(
         "SELECT * FROM threads WHERE thread_id = ?",
@@ -96,36 +219,145 @@ def thread_get(connection, thread_id, messages=True, op_only=False):
         raise BBJParameterError("Thread does not exist.")
     thread = schema.thread(*thread)
 
-    if messages or op_only:
-        query = "SELECT * FROM messages WHERE thread_id = ? %s"
-        c.execute(query % (
-            "AND post_id = 0" if op_only else "ORDER BY post_id"
-        ), (thread_id,))
-        # create a list where each post_id matches its list[index]
+    if op_only:
+        c.execute(
+            "SELECT * FROM messages WHERE thread_id = ? AND post_id = 0",
+            (thread_id,))
         thread["messages"] = [schema.message(*values) for values in c.fetchall()]
 
+    elif messages:
+        # these are all ranges over the (thread_id, post_id) primary key
+        query = "SELECT * FROM messages WHERE thread_id = ?"
+        params = [thread_id]
+        if after is not None:
+            query += " AND post_id > ?"
+            params.append(after)
+        if before is not None:
+            query += " AND post_id < ?"
+            params.append(before)
+        # a page that ends at BEFORE is read backwards from it
+        backwards = limit is not None and before is not None and after is None
+        query += " ORDER BY post_id DESC" if backwards else " ORDER BY post_id"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        rows = c.execute(query, params).fetchall()
+        if backwards:
+            rows.reverse()
+        thread["messages"] = [schema.message(*values) for values in rows]
+
     return thread
 
 
-def thread_index(connection, include_op=False):
+def thread_updates(connection, thread_id, after, since=None):
+    """
+    Returns the changes to thread_id that a client which already has
+    the thread does not have yet:
+
+    {
+        "thread": ...thread object, without "messages",
+        "messages": [...standard message object array sorted by post_id],
+        "time": a unix/epoch timestamp to pass back in as SINCE
+    }
+
+    "messages" holds the messages with a post_id greater than AFTER and,
+    when SINCE is given, those edited or deleted after that unix/epoch
+    timestamp.
+    """
+    for name, value in (("after_post_id", after), ("since", since)):
+        if value is not None and (
+                not isinstance(value, (int, float)) or isinstance(value, bool)):
+            raise BBJParameterError("{} must be a number.".format(name))
+
+    # an edit stamps its message before committing it, so an edit still
+    # in flight now may show up with a time slightly before this one.
+    # the returned time overlaps a little to catch those the next time.
+    now = time() - 1
+    thread = thread_get(connection, thread_id, messages=False)
+    if since is None:
+        rows = connection.execute("""
+            SELECT * FROM messages
+              WHERE thread_id = ? AND post_id > ?
+              ORDER BY post_id""", (thread_id, after))
+    else:
+        rows = connection.execute("""
+            SELECT * FROM messages
+              WHERE thread_id = ?
+                AND (post_id > ? OR last_mod > ?)
+              ORDER BY post_id""", (thread_id, after, since))
+    messages = [schema.message(*values) for values in rows]
+    return {
+        "thread": thread,
+        "messages": messages,
+        "time": now
+    }
+
+
+def thread_index(connection, include_op=False, include_summary=False):
     """
     Return a list with each thread, ordered by the date they
     were last modifed (which could be when it was submitted
     or its last reply)
 
-    Please note that thred["messages"] is omitted.
-    """
-    c = connection.execute("""
-        SELECT thread_id FROM threads
-          ORDER BY last_mod DESC""")
+    Please note that thred["messages"] is omitted, unless INCLUDE_OP
+    is given, in which case it is a list with only the original post.
+    With INCLUDE_SUMMARY, each thread has a "summary" from the
+    thread_summary table (see summarize).
 
-    threads = [
-        thread_get(connection, obj[0], False, include_op)
-            for obj in c.fetchall()
-    ]
+    This is done with a single query instead of a thread_get for
+    every thread: the OP and summary are joined onto each row of the
+    index. The summary is far cheaper to join than the OP, which
+    has to be looked up among the messages.
+    """
+    columns, joins = ["threads.*"], []
+    if include_op:
+        columns.append("messages.*")
+        joins.append("""
+          LEFT JOIN messages
+            ON messages.thread_id = threads.thread_id
+           AND messages.post_id = 0""")
+    if include_summary:
+        columns.append("op_preview, last_preview, participants")
+        joins.append("""
+          LEFT JOIN thread_summary
+            ON thread_summary.thread_id = threads.thread_id""")
+
+    threads = list()
+    for obj in connection.execute("""
+        SELECT %s FROM threads %s
+          ORDER BY threads.last_mod DESC""" % (", ".join(columns), "".join(joins))):
+        # the first 8 columns are the thread, then come the 8 of
+        # its OP and the 3 of its summary when they were asked for
+        thread = schema.thread(*obj[:8])
+        rest = obj[8:]
+        if include_op:
+            op, rest = rest[:8], rest[8:]
+            thread["messages"] = [schema.message(*op)] if op[0] else []
+        if include_summary:
+            thread["summary"] = schema.thread_summary(*rest)
+        threads.append(thread)
     return threads
 
 
+def summarize(connection, thread_id, post_id, body):
+    """
+    Update the summary of thread_id now that the body of its message
+    post_id was changed to BODY, as part of the caller's transaction.
+
+    New messages are summarized by thread_create and thread_reply
+    themselves, and message_delete counts the participants again.
+    """
+    text = preview(body)
+    connection.execute("""
+        UPDATE thread_summary SET
+        op_preview = CASE WHEN ? = 0 THEN ? ELSE op_preview END,
+        last_preview = CASE WHEN ? = (
+            SELECT reply_count FROM threads WHERE thread_id = ?)
+          THEN ? ELSE last_preview END
+        WHERE thread_id = ?
+    """, (post_id, text, post_id, thread_id, text, thread_id))
+
+
 def thread_set_pin(connection, thread_id, pin_bool):
     """
     Set the pinned status of thread_id to pin_bool.
@@ -138,12 +370,16 @@ def thread_set_pin(connection, thread_id, pin_bool):
         WHERE thread_id = ?
     """, (pin_bool, thread_id))
     connection.commit()
+    bump(thread_id, "pin",
+         thread=thread_get(connection, thread_id, messages=False))
     return pin_bool
 
 
 def thread_create(connection, author_id, body, title, send_raw=False):
     """
-    Create a new thread and return it.
+    Create a new thread and return it, with its OP as its only message.
+    The thread and everything kept along with it are written in a
+    single transaction.
     """
     validate([
         ("body",  body),
@@ -152,84 +388,122 @@ def thread_create(connection, author_id, body, title, send_raw=False):
 
     now = time()
     thread_id = uuid1().hex
-    scheme = schema.thread(
+    thread = schema.thread(
         thread_id, author_id, title,
-        now, now, -1, # see below for why i set -1 instead of 0
-        False, author_id)
+        now, now, 0, False, author_id)
+    message = schema.message(
+        thread_id, 0, author_id,
+        now, False, body, bool(send_raw), now)
 
     connection.execute("""
         INSERT INTO threads
         VALUES (?,?,?,?,?,?,?,?)
-    """, schema_values("thread", scheme))
+    """, schema_values("thread", thread))
+    connection.execute("""
+        INSERT INTO messages
+        VALUES (?,?,?,?,?,?,?,?)
+    """, schema_values("message", message))
+    connection.execute("""
+        INSERT INTO thread_summary
+        VALUES (?,?,?,?)
+    """, (thread_id, preview(body), preview(body), 1))
+    search_add(connection, thread_id, 0, body, title)
     connection.commit()
-    # the thread is initially commited with reply_count -1 so that i can
-    # just pass the message to the reply method, instead of duplicating
-    # its code here. It then increments to 0.
-    thread_reply(connection, author_id, thread_id, body, send_raw, time_override=now)
-    # fetch the new thread out of the database instead of reusing the returned
-    # objects, just to be 100% sure what is returned is what was committed
-    return thread_get(connection, thread_id)
+
+    bump(thread_id, "reply", thread=dict(thread), message=dict(message))
+    thread["messages"] = [message]
+    return thread
 
 
-def thread_reply(connection, author_id, thread_id, body, send_raw=False, time_override=None):
+def thread_reply(connection, author_id, thread_id, body, send_raw=False):
     """
     Submit a new reply for thread_id. Return the new reply object.
 
-    time_overide can be a time() value to set as the new message time.
-    This is to keep post_id 0 in exact parity with its parent thread.
+    The reply is written in a single transaction, which starts by
+    taking the next post_id from the thread's reply_count. That takes
+    the database's write lock, so concurrent replies each get their
+    own post_id instead of colliding on the same one.
     """
     validate([("body", body)])
 
-    now = time_override or time()
-    thread = thread_get(connection, thread_id, messages=False)
-    thread["reply_count"] += 1
+    now = time()
+    updated = connection.execute("""
+        UPDATE threads SET
+        reply_count = reply_count + 1,
+        last_author = ?,
+        last_mod = ?
+        WHERE thread_id = ?
+    """, (author_id, now, thread_id)).rowcount
+    if not updated:
+        connection.rollback()
+        raise BBJParameterError("Thread does not exist.")
+
+    # the write lock is held from the UPDATE on, so this reads back the
+    # reply_count it just set (RETURNING would need SQLite 3.35)
+    thread = schema.thread(*connection.execute(
+        "SELECT * FROM threads WHERE thread_id = ?", (thread_id,)).fetchone())
     count = thread["reply_count"]
     scheme = schema.message(
         thread_id, count, author_id,
-        now, False, body, bool(send_raw))
+        now, False, body, bool(send_raw), now)
 
     connection.execute("""
         INSERT INTO messages
-        VALUES (?,?,?,?,?,?,?)
+        VALUES (?,?,?,?,?,?,?,?)
     """, schema_values("message", scheme))
 
+    # the reply is the thread's last message, and its author is new
+    # to the thread unless one of the messages before it is theirs
+    # (deleted ones are not counted, see message_delete)
     connection.execute("""
-        UPDATE threads SET
-        reply_count = ?,
-        last_author = ?,
-        last_mod = ?
+        UPDATE thread_summary SET
+        last_preview = ?,
+        participants = participants + NOT EXISTS (
+            SELECT 1 FROM messages
+              WHERE thread_id = ? AND author = ? AND post_id < ?
+                AND body != '[deleted]')
         WHERE thread_id = ?
-    """, (count, author_id, now, thread_id))
+    """, (preview(body), thread_id, author_id, count, thread_id))
+    search_add(connection, thread_id, count, body)
 
     connection.commit()
+    bump(thread_id, "reply", thread=thread, message=scheme)
     return scheme
 
 
-def message_delete(connection, author, thread_id, post_id):
+def message_delete(connection, user, thread_id, post_id):
     """
     'Delete' a message from a thread. If the message being
     deleted is an OP [post_id == 0], delete the whole thread.
 
-    Requires an author id, the thread_id, and post_id.
-    The same rules for edits apply to deletions: the same
+    Requires the user object of the deleter, the thread_id, and
+    post_id. The same rules for edits apply to deletions: the same
     error objects are returned. Returns True on success.
     """
-    message_edit_query(connection, author, thread_id, post_id)
+    message = message_edit_query(connection, user, thread_id, post_id)
 
     if post_id == 0:
         # NUKE NUKE NUKE NUKE
+        reply_count = connection.execute(
+            "SELECT reply_count FROM threads WHERE thread_id = ?",
+            (thread_id,)).fetchone()[0]
         connection.execute("DELETE FROM threads WHERE thread_id = ?", (thread_id,))
         connection.execute("DELETE FROM messages WHERE thread_id = ?", (thread_id,))
+        connection.execute("DELETE FROM thread_summary WHERE thread_id = ?", (thread_id,))
+        search_remove(connection, thread_id)
+        formatting.invalidate(thread_id, range(reply_count + 1))
 
     else:
+        now = time()
         connection.execute("""
             UPDATE messages SET
             author = ?,
             body = ?,
-            edited = ?
+            edited = ?,
+            last_mod = ?
             WHERE thread_id = ?
             AND post_id = ?
-        """, (anon["user_id"], "[deleted]", False, thread_id, post_id))
+        """, (anon["user_id"], "[deleted]", False, now, thread_id, post_id))
         # DONT deincrement the reply_count of this thread,
         # or even delete the message itself. This breaks
         # balance between post_id and the post's index when
@@ -237,22 +511,52 @@ def message_delete(connection, author, thread_id, post_id):
         # *actually* deleting messages, which would be ideal,
         # would increase implementation complexity for clients.
         # IMO, that is not worth it. Threads are fair game.
+        summarize(connection, thread_id, post_id, "[deleted]")
+        search_remove(connection, thread_id, post_id)
+        # the author may have no other messages left in the thread. The
+        # deleted message now belongs to anon, and deleted messages are
+        # not counted, or deleting one would count anon as a participant
+        connection.execute("""
+            UPDATE thread_summary SET
+            participants = (
+                SELECT count(DISTINCT author) FROM messages
+                  WHERE thread_id = ? AND body != '[deleted]')
+            WHERE thread_id = ?
+        """, (thread_id, thread_id))
+        formatting.invalidate(thread_id, [post_id])
 
     connection.commit()
+    if post_id == 0:
+        bump(thread_id, "delete_thread")
+    else:
+        message.update(
+            author=anon["user_id"], body="[deleted]", edited=False, last_mod=now)
+        bump(thread_id, "edit", message=message,
+             thread=thread_get(connection, thread_id, messages=False))
     return True
 
 
-def message_edit_query(connection, author, thread_id, post_id):
+def message_edit_query(connection, user, thread_id, post_id):
     """
-    Perform all the neccesary sanity checks required to edit a post
-    and then return the requested message object without any changes.
+    Perform all the neccesary sanity checks required for USER, the
+    user object of the editor, to edit a post and then return the
+    requested message object without any changes.
     """
-    user = user_resolve(connection, author)
-    thread = thread_get(connection, thread_id)
-
-    try: message = thread["messages"][post_id]
-    except IndexError:
+    if not isinstance(post_id, int) or isinstance(post_id, bool):
+        raise BBJParameterError("post_id must be an integer.")
+
+    message = connection.execute("""
+        SELECT * FROM messages
+          WHERE thread_id = ? AND post_id = ?
+    """, (thread_id, post_id)).fetchone()
+
+    if not message:
+        thread = connection.execute(
+            "SELECT 1 FROM threads WHERE thread_id = ?", (thread_id,)).fetchone()
+        if not thread:
+            raise BBJParameterError("Thread does not exist.")
         raise BBJParameterError("post_id out of bounds for requested thread")
+    message = schema.message(*message)
 
     if not user["is_admin"]:
         if not user["user_id"] == message["author"]:
@@ -268,7 +572,7 @@ def message_edit_query(connection, author, thread_id, post_id):
 
 def message_edit_commit(
         connection,
-        author_id,
+        user,
         thread_id,
         post_id,
         new_body,
@@ -288,7 +592,7 @@ def message_edit_commit(
     Touches base with message_edit_query first. Returns
     the newly updated message object.
     """
-    message = message_edit_query(connection, author_id, thread_id, post_id)
+    message = message_edit_query(connection, user, thread_id, post_id)
 
     if new_body == None:
         new_body = message["body"]
@@ -304,23 +608,143 @@ def message_edit_commit(
     else:
         display = bool(set_display)
 
+    now = time()
     connection.execute("""
         UPDATE messages SET
         body = ?,
         send_raw = ?,
-        edited = ?
+        edited = ?,
+        last_mod = ?
         WHERE thread_id = ?
           AND post_id = ?
-    """, (new_body, send_raw, display, thread_id, post_id))
+    """, (new_body, send_raw, display, now, thread_id, post_id))
+    summarize(connection, thread_id, post_id, new_body)
+    connection.execute("""
+        UPDATE search SET
+        body = ?
+        WHERE rowid = (
+          SELECT search_rowid FROM search_rows
+            WHERE thread_id = ? AND post_id = ?)
+    """, (new_body, thread_id, post_id))
     connection.commit()
+    formatting.invalidate(thread_id, [post_id])
 
     message["body"] = new_body
     message["send_raw"] = send_raw
     message["edited"] = display
+    message["last_mod"] = now
+    bump(thread_id, "edit", message=dict(message),
+         thread=thread_get(connection, thread_id, messages=False))
 
     return message
 
 
+### SEARCH ###
+
+# marks the start and end of each match in the snippets from the index
+MATCH_START, MATCH_END = "\x02", "\x03"
+
+
+def search(connection, query, limit=20, offset=0):
+    """
+    Search the bodies of all messages and the titles of all threads
+    for the words of QUERY, and return a page of the hits, best first:
+
+    {
+        "hits": [...hit objects],
+        "next": null or the offset of the next page
+    }
+
+    Each hit has the "thread_id", "post_id", "author" and "created" of
+    the message that matched, the "title" of its thread, and a "snippet"
+    of the text around the match, in the same form as a line of
+    sequential formatting: [[null, "text"], ["match", "word"], ...].
+    A match in a title is a hit on the thread's OP.
+
+    Every word must occur for a message to match. Words are matched by
+    their start when they end with a *. No other query syntax is used.
+    """
+    for name, value, least in (("limit", limit, 1), ("offset", offset, 0)):
+        if not isinstance(value, int) or isinstance(value, bool) or value < least:
+            raise BBJParameterError("{} must be {} integer.".format(
+                name, "a positive" if least else "a non-negative"))
+    limit = min(limit, 100)
+
+    terms = []
+    for word in str(query).split():
+        prefix = word.endswith("*")
+        word = word.rstrip("*")
+        if word:
+            terms.append('"%s"%s' % (word.replace('"', '""'), "*" if prefix else ""))
+    if not terms:
+        raise BBJParameterError("query must contain at least one word.")
+
+    rows = connection.execute("""
+        SELECT search.thread_id, search.post_id,
+               messages.author, messages.created, threads.title,
+               snippet(search, -1, ?, ?, '...', 24)
+          FROM search
+          JOIN messages
+            ON messages.thread_id = search.thread_id
+           AND messages.post_id = search.post_id
+          JOIN threads ON threads.thread_id = search.thread_id
+          WHERE search MATCH ?
+          -- title matches weigh twice as much as body matches
+          ORDER BY bm25(search, 2.0, 1.0, 0.0, 0.0)
+          LIMIT ? OFFSET ?""", (
+        MATCH_START, MATCH_END, " ".join(terms), limit + 1, offset)).fetchall()
+
+    hits = [{
+        "thread_id": thread_id,
+        "post_id":   post_id,
+        "author":    author,
+        "created":   created,
+        "title":     title,
+        "snippet":   [
+            ["match" if index % 2 else None, text] for index, text in
+            enumerate(re.split("[%s%s]" % (MATCH_START, MATCH_END), snippet))
+            if text
+        ]
+    } for thread_id, post_id, author, created, title, snippet in rows[:limit]]
+
+    return {
+        "hits": hits,
+        "next": offset + limit if len(rows) > limit else None
+    }
+
+
+def search_add(connection, thread_id, post_id, body, title=None):
+    """
+    Add a new message to the search index, as part of the caller's
+    transaction. TITLE is given for OPs only.
+    """
+    rowid = connection.execute("""
+        INSERT INTO search (title, body, thread_id, post_id)
+        VALUES (?,?,?,?)
+    """, (title, body, thread_id, post_id)).lastrowid
+    connection.execute("""
+        INSERT OR REPLACE INTO search_rows
+        VALUES (?,?,?)
+    """, (thread_id, post_id, rowid))
+
+
+def search_remove(connection, thread_id, post_id=None):
+    """
+    Remove a message from the search index, or every message in the
+    thread when POST_ID is None, as part of the caller's transaction.
+    """
+    condition = "thread_id = ?"
+    params = [thread_id]
+    if post_id is not None:
+        condition += " AND post_id = ?"
+        params.append(post_id)
+    connection.execute("""
+        DELETE FROM search WHERE rowid IN (
+          SELECT search_rowid FROM search_rows WHERE %s)
+    """ % condition, params)
+    connection.execute("DELETE FROM search_rows WHERE %s" % condition, params)
+
+
 ### USERS ####
 
 
@@ -348,6 +772,8 @@ def user_register(connection, user_name, auth_hash):
     """, schema_values("user", scheme))
 
     connection.commit()
+    user_cache.invalidate(scheme["user_id"], user_name)
+    user_written()
     return scheme
 
 
@@ -360,14 +786,21 @@ def user_resolve(connection, name_or_id, externalize=False, return_false=True):
     RETURN_FALSE determines whether to raise an exception or just
     return bool False if the user doesn't exist
     """
-    user = connection.execute("""
-         SELECT * FROM users
-         WHERE user_name = ?
-            OR user_id = ? """,
-        (name_or_id, name_or_id)).fetchone()
+    user = user_cache.get(name_or_id)
+    if not user:
+        generation = user_cache.generation
+        user = connection.execute("""
+             SELECT * FROM users
+             WHERE user_name = ?
+                OR user_id = ? """,
+            (name_or_id, name_or_id)).fetchone()
+        if user:
+            user = schema.user_internal(*user)
+            user_cache.put(user["user_id"], user, generation)
+            user_cache.put(user["user_name"], user, generation)
 
     if user:
-        user = schema.user_internal(*user)
+        user = dict(user)
         if externalize:
             return user_externalize(user)
         return user
@@ -379,6 +812,50 @@ def user_resolve(connection, name_or_id, externalize=False, return_false=True):
         " is not registered".format(name_or_id))
 
 
+def user_resolve_many(connection, user_ids, externalize=True):
+    """
+    Accepts an iterable of user_ids and returns a dictionary mapping
+    each of them to their full user object. Users found in the cache
+    are taken from there and the rest are fetched with as few queries
+    as possible, rather than one user_resolve for each.
+
+    EXTERNALIZE determines whether to strip the objects of private data.
+    Raises BBJParameterError if any of the users are not registered.
+    """
+    users, missing = dict(), list()
+    for user_id in set(user_ids):
+        user = user_cache.get(user_id)
+        if user:
+            users[user_id] = user
+        else:
+            missing.append(user_id)
+
+    generation = user_cache.generation
+    # stay well under SQLite's limit on the number of bound variables
+    for index in range(0, len(missing), 500):
+        chunk = missing[index:index + 500]
+        for row in connection.execute(
+                "SELECT * FROM users WHERE user_id IN (%s)"
+                % ",".join("?" * len(chunk)), chunk):
+            user = schema.user_internal(*row)
+            user_cache.put(user["user_id"], user, generation)
+            user_cache.put(user["user_name"], user, generation)
+            users[user["user_id"]] = user
+
+    for user_id in missing:
+        if user_id not in users:
+            raise BBJParameterError(
+                "Requested user element ({})"
+                " is not registered".format(user_id))
+
+    if externalize:
+        return {
+            user_id: user_externalize(dict(user))
+            for user_id, user in users.items()
+        }
+    return {user_id: dict(user) for user_id, user in users.items()}
+
+
 def user_update(connection, user_object, parameters):
     """
     Accepts new parameters for a user object and then
@@ -387,6 +864,7 @@ def user_update(connection, user_object, parameters):
     and anything undefined) are ignored completely.
     """
     user_id = user_object["user_id"]
+    old_name = user_object["user_name"]
     for key in ("user_name", "auth_hash", "quip", "bio", "color"):
         value = parameters.get(key)
         # bool(0) == False hur hur hurrrrrr ::drools::
@@ -408,6 +886,8 @@ def user_update(connection, user_object, parameters):
         """, values)
 
     connection.commit()
+    user_cache.invalidate(user_id, old_name)
+    user_written()
     return user_resolve(connection, user_id)
 
 
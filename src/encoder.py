@@ -0,0 +1,108 @@
+"""
+Encodes API responses to JSON. Serialization is the bulk of the work
+for big responses like thread_load and user_map, so a faster library
+than the json module is used when one is installed (see ENCODERS). The
+output differs only in whitespace and escaping: the json module escapes
+everything outside of ASCII as \\uXXXX, while orjson sends it as UTF-8,
+so clients must decode response bodies as UTF-8 (which JSON requires
+anyway) rather than as ASCII or bytes.
+
+iterencode() encodes a response a piece at a time instead, so a big one
+can be sent while it is being encoded rather than after it has been
+built up whole in memory.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps_json(obj):
+    return bytes(json.dumps(obj, separators=(",", ":")), "utf8")
+
+
+def dumps_orjson(obj):
+    try:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    except orjson.JSONEncodeError:
+        # orjson refuses strings with lone surrogates, which the json
+        # module will happily read in from a request and write back out
+        return dumps_json(obj)
+
+
+# the encoders that can be chosen with use(), by name
+ENCODERS = {"json": dumps_json}
+if orjson:
+    ENCODERS["orjson"] = dumps_orjson
+
+# the encoder in use, the fastest one installed unless use() says otherwise
+dumps = dumps_orjson if orjson else dumps_json
+
+
+def use(name):
+    """
+    Encode with the encoder NAME from ENCODERS, or with the fastest one
+    installed when NAME is "auto". Raises ValueError for encoders that
+    are not installed.
+    """
+    global dumps
+    if name == "auto":
+        dumps = dumps_orjson if orjson else dumps_json
+    elif name in ENCODERS:
+        dumps = ENCODERS[name]
+    else:
+        raise ValueError("JSON encoder %r is not installed, use one of: %s"
+                         % (name, ", ".join(["auto"] + sorted(ENCODERS))))
+
+
+def pieces(obj, batch=256):
+    """
+    Yields the JSON encoding of OBJ in pieces. Arrays, and objects with
+    more than BATCH members, are split into runs of BATCH items that are
+    each encoded in one go, as that is where the bulk of a response is
+    (messages, threads, the usermap). Smaller objects are split up by
+    member, so a big array inside one is still found and split.
+    """
+    if isinstance(obj, dict) and len(obj) > batch:
+        items = list(obj.items())
+        yield b"{"
+        for start in range(0, len(items), batch):
+            yield (b"," if start else b"") + \
+                dumps(dict(items[start:start + batch]))[1:-1]
+        yield b"}"
+
+    elif isinstance(obj, dict) and all(isinstance(key, str) for key in obj):
+        yield b"{"
+        for index, (key, value) in enumerate(obj.items()):
+            yield (b"," if index else b"") + dumps(key) + b":"
+            yield from pieces(value, batch)
+        yield b"}"
+
+    elif isinstance(obj, (list, tuple)):
+        yield b"["
+        for start in range(0, len(obj), batch):
+            yield (b"," if start else b"") + \
+                dumps(list(obj[start:start + batch]))[1:-1]
+        yield b"]"
+
+    else:
+        yield dumps(obj)
+
+
+def iterencode(obj, chunk_size=65536):
+    """
+    Yields the JSON encoding of OBJ in chunks of bytes, each about
+    CHUNK_SIZE long. A small OBJ comes out in a single chunk.
+    """
+    chunk, size = [], 0
+    for piece in pieces(obj):
+        chunk.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield b"".join(chunk)
+            chunk, size = [], 0
+    if chunk:
+        yield b"".join(chunk)
@@ -0,0 +1,91 @@
+"""
+A log of recent activity on the board, kept in memory so that clients
+can wait for new activity instead of polling for it. The functions in
+db.py publish an event after each write they commit, and the waiters
+are woken up to read what is new straight out of the log: waking any
+number of them costs no database queries.
+
+Events are numbered in order. A client keeps the cursor it was given
+with its last batch of events and sends it back to get the ones that
+came after it. Only the most recent events are kept, so a client that
+falls too far behind is told it missed some and should reload instead.
+
+Waiting with wait() holds a thread for as long as it waits. Servers that
+wait some other way can register a listener to be told about new events.
+"""
+
+from collections import deque
+from threading import Condition
+
+
+class EventLog(object):
+    """
+    Keeps the last SIZE events and lets at most MAX_WAITERS requests
+    wait for new ones at once.
+    """
+    def __init__(self, size=1000, max_waiters=10):
+        self.events = deque(maxlen=size)
+        self.max_waiters = max_waiters
+        self.cursor = 0
+        self.waiters = 0
+        self.condition = Condition()
+        self.listeners = []
+
+
+    def publish(self, **event):
+        """
+        Add an event made of the given keyword arguments and wake
+        up everyone waiting.
+        """
+        with self.condition:
+            self.cursor += 1
+            self.events.append((self.cursor, event))
+            self.condition.notify_all()
+        for listener in self.listeners:
+            listener()
+
+
+    def listen(self, callback):
+        """
+        Call CALLBACK with no arguments after each publish, from the
+        thread that published.
+        """
+        self.listeners.append(callback)
+
+
+    def since(self, cursor):
+        """
+        Returns a tuple of the events after CURSOR, whether any of
+        them are no longer in the log, and the cursor to use next.
+        """
+        with self.condition:
+            if cursor > self.cursor:
+                # the cursor is from before a restart
+                return [], True, self.cursor
+            events = [event for number, event in self.events if number > cursor]
+            oldest = self.events[0][0] if self.events else self.cursor + 1
+            return events, cursor < self.cursor and oldest > cursor + 1, self.cursor
+
+
+    def wait(self, cursor, timeout):
+        """
+        Block until there are events after CURSOR or TIMEOUT seconds
+        pass, then return the same tuple as since(). A CURSOR of None
+        waits for the next event from now on. Returns None without
+        waiting when MAX_WAITERS requests are already waiting.
+        """
+        with self.condition:
+            if cursor is None:
+                cursor = self.cursor
+
+            if cursor == self.cursor and timeout > 0:
+                if self.waiters >= self.max_waiters:
+                    return None
+                self.waiters += 1
+                try:
+                    self.condition.wait_for(
+                        lambda: self.cursor != cursor, timeout)
+                finally:
+                    self.waiters -= 1
+
+            return self.since(cursor)
@@ -62,6 +62,7 @@ Just like the brackets themselves, backslashes may occur freely within bodies,
 they are only removed when they occur before a valid expression.
 """
 
+from src.cache import LRUCache
 from string import punctuation
 import re
 
@@ -80,6 +81,17 @@ quotes = re.compile(">>([0-9]+)")
 bold = re.compile(r"(?<!\\)\*{2}(.+?)(?<!\\)\*{2}")
 underline = re.compile(r"(?<!\\)_{2}(.+?)(?<!\\)_{2}")
 escapes = re.compile(r"\\([*_]{2})")
+# the characters sequential_expressions has to look at, all others are text
+specials = re.compile(r"[\[\]\\]")
+
+directives = colors + markup
+longest_directive = max(len(directive) for directive in directives)
+
+# formatted bodies of stored messages, keyed by (thread_id, post_id). Each
+# entry maps the name of a formatter to a tuple of the raw body it was made
+# from and the output, so a body that changed is never served stale, even
+# before the edit invalidates it. The server sets its size from the config.
+cache = LRUCache(10000)
 
 
 def apply_directives(text):
@@ -106,18 +118,17 @@ def parse_segments(text, sanitize_linequotes=True):
     """
     result = list()
     for paragraph in re.split("\n{2,}", text):
-        pg = str()
+        pg = list()
         for line in paragraph.split("\n"):
             if linequote_p(line):
                 if sanitize_linequotes:
                     inner = line.replace("]", "\\]")
                 else:
                     inner = apply_directives(line)
-                pg += "[linequote: %s]" % inner
+                pg.append("[linequote: %s]" % inner)
             else:
-                pg += apply_directives(line)
-            pg += "\n"
-        result.append(pg.rstrip())
+                pg.append(apply_directives(line))
+        result.append("\n".join(pg).rstrip())
     return result
 
 
@@ -136,49 +147,72 @@ def sequential_expressions(string):
         "[bold: [red: this] is some shit [green: it cant handle]]"
     you get:
     [('red', 'this'), ('bold', ' is some shit '), ('green', 'it cant handle')]
+
+    The text between brackets and backslashes is copied over in whole
+    runs, and the search for the ": " ending a directive name is shared
+    between brackets, so this runs in linear time on any input.
     """
     # abandon all hope ye who enter here
-    directives = colors + markup
     result = list()
     for paragraph in parse_segments(string):
-        stack = [[None, str()]]
-        skip_iters = 0
+        length = len(paragraph)
+        stack = [[None, list()]]
         nest = [None]
         escaped = False
-        for index, char in enumerate(paragraph):
-            if skip_iters:
-                skip_iters -= 1
-                continue
-
-            if not escaped and char == "[":
-                directive = paragraph[index+1:paragraph.find(": ", index+1)]
-                open_p = directive in directives
-            else:
-                open_p = False
-            clsd_p = not escaped and nest[-1] != None and char == "]"
+        # the position of the next ": " at or after index + 1
+        colon = -1
+        index = 0
+        while index < length:
+            match = specials.search(paragraph, index)
+            position = match.start() if match else length
+            if position > index:
+                stack[-1][1].append(paragraph[index:position])
+                escaped = False
+            if not match:
+                break
+
+            char = paragraph[position]
+            index = position + 1
+            open_p = clsd_p = False
+            if escaped:
+                pass
+
+            elif char == "[":
+                if colon < index and colon != length:
+                    colon = paragraph.find(": ", index)
+                    if colon == -1:
+                        colon = length
+                # without a ": " the name runs up to the paragraph's last char
+                end = colon if colon != length else length - 1
+                # only slice out names that could be a directive
+                if end - index <= longest_directive:
+                    directive = paragraph[index:end]
+                    open_p = directive in directives
+
+            elif char == "]":
+                clsd_p = nest[-1] != None
 
             # dont splice other directives into linequotes: that is far
             # too confusing for the client to determine where to put line
             # breaks
             if open_p and nest[-1] != "linequote":
-                stack.append([directive, str()])
+                stack.append([directive, list()])
                 nest.append(directive)
-                skip_iters += len(directive) + 2
+                index += len(directive) + 2
 
             elif clsd_p:
                 nest.pop()
-                stack.append([nest[-1], str()])
+                stack.append([nest[-1], list()])
 
             else:
                 escaped = char == "\\"
-                try:
-                    n = paragraph[index + 1]
-                except IndexError:
-                    n = " "
+                n = paragraph[index] if index < length else " "
                 if not (escaped and n in "[]"):
-                    stack[-1][1] += char
+                    stack[-1][1].append(char)
         # filter out unused bodies, eg ["red", ""]
-        result.append([(directive, body) for directive, body in stack if body])
+        result.append([
+            (directive, "".join(body)) for directive, body in stack if body
+        ])
     return result
 
 
@@ -191,10 +225,44 @@ def apply_formatting(msg_obj, formatter):
     """
     for x, obj in enumerate(msg_obj):
         if not msg_obj[x].get("send_raw"):
-            msg_obj[x]["body"] = formatter(obj["body"])
+            msg_obj[x]["body"] = format_cached(obj, formatter)
     return msg_obj
 
 
+def format_cached(message, formatter):
+    """
+    Returns the body of MESSAGE passed through FORMATTER, reusing the
+    output from an earlier call when the body has not changed since.
+    Messages that are not stored in a thread are not cached.
+    """
+    body = message["body"]
+    if "thread_id" not in message:
+        return formatter(body)
+
+    key = (message["thread_id"], message["post_id"])
+    entry = cache.get(key)
+    if entry:
+        made_from, output = entry.get(formatter.__name__, (None, None))
+        if made_from == body:
+            return output
+    else:
+        generation = cache.generation
+
+    output = formatter(body)
+    if entry:
+        entry[formatter.__name__] = (body, output)
+    else:
+        cache.put(key, {formatter.__name__: (body, output)}, generation)
+    return output
+
+
+def invalidate(thread_id, post_ids):
+    """
+    Drop the cached output for the messages POST_IDS of THREAD_ID.
+    """
+    cache.invalidate(*[(thread_id, post_id) for post_id in post_ids])
+
+
 def raw(text):
     """
     Just return the message in the same state that it was submitted.
@@ -0,0 +1,143 @@
+"""
+Counts the requests to each API method and how long they took, split
+up by where the time went, for the metrics endpoint to report in the
+Prometheus text format.
+
+A request's time is split into phases: "db" is the time spent in the
+API method itself, which is nearly all spent waiting on the database
+(or the write queue), "format" the part of that spent running messages
+through a formatter, and "serialize" the time spent encoding and
+compressing the response, which for a streamed response is spread out
+over sending it. "total" runs from the start of the request until the
+last chunk of the response has been made.
+
+Like the caches, these are kept by each process. When the server runs
+several worker processes, the endpoint reports only the one that
+answered it.
+"""
+
+from bisect import bisect_left
+from threading import Lock
+
+# upper bounds of the latency histograms' buckets, in seconds
+BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+PHASES = ("total", "db", "format", "serialize")
+
+
+class Histogram(object):
+    """
+    Counts of observed values by the first of BUCKETS they fit in
+    (with one more for those bigger than all of them), and their sum.
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Endpoint(object):
+    """
+    What has been recorded for the requests to one API method.
+    """
+    def __init__(self):
+        self.statuses = {}
+        self.errors = {}
+        self.bytes_out = 0
+        self.phases = {phase: Histogram() for phase in PHASES}
+
+
+class Metrics(object):
+    """
+    The metrics of every API method requested so far, by name.
+    """
+    def __init__(self):
+        self.endpoints = {}
+        self.lock = Lock()
+
+
+    def record(self, name, status, error, bytes_out, timings):
+        """
+        Record a request to NAME answered with the HTTP STATUS, the
+        code of the ERROR it returned (or None), BYTES_OUT bytes of body
+        and TIMINGS, a dictionary of the seconds spent in each of PHASES.
+        """
+        with self.lock:
+            endpoint = self.endpoints.get(name)
+            if endpoint is None:
+                endpoint = self.endpoints[name] = Endpoint()
+            endpoint.statuses[status] = endpoint.statuses.get(status, 0) + 1
+            if error is not None:
+                endpoint.errors[error] = endpoint.errors.get(error, 0) + 1
+            endpoint.bytes_out += bytes_out
+            for phase, seconds in timings.items():
+                endpoint.phases[phase].observe(seconds)
+
+
+    def render(self, others=()):
+        """
+        Returns the metrics in the Prometheus text format, followed by
+        OTHERS, a list of (name, type, help, {labels: value}) tuples of
+        other metrics to report, where each labels is a tuple of
+        (label, value) pairs.
+        """
+        with self.lock:
+            endpoints = sorted(self.endpoints.items())
+            lines = [
+                "# HELP bbj_requests_total Requests by API method and HTTP status.",
+                "# TYPE bbj_requests_total counter"]
+            for name, endpoint in endpoints:
+                for status, count in sorted(endpoint.statuses.items()):
+                    lines.append('bbj_requests_total{endpoint="%s",status="%d"} %d'
+                                 % (name, status, count))
+
+            lines += [
+                "# HELP bbj_errors_total Error responses by API method and error code.",
+                "# TYPE bbj_errors_total counter"]
+            for name, endpoint in endpoints:
+                for code, count in sorted(endpoint.errors.items()):
+                    lines.append('bbj_errors_total{endpoint="%s",code="%d"} %d'
+                                 % (name, code, count))
+
+            lines += [
+                "# HELP bbj_response_bytes_total Bytes of response bodies sent, "
+                "after compression.",
+                "# TYPE bbj_response_bytes_total counter"]
+            for name, endpoint in endpoints:
+                lines.append('bbj_response_bytes_total{endpoint="%s"} %d'
+                             % (name, endpoint.bytes_out))
+
+            lines += [
+                "# HELP bbj_request_seconds Time spent answering requests, "
+                "by API method and phase.",
+                "# TYPE bbj_request_seconds histogram"]
+            for name, endpoint in endpoints:
+                for phase in PHASES:
+                    histogram = endpoint.phases[phase]
+                    labels = 'endpoint="%s",phase="%s"' % (name, phase)
+                    count = 0
+                    for bound, observed in zip(histogram.buckets, histogram.counts):
+                        count += observed
+                        lines.append('bbj_request_seconds_bucket{%s,le="%s"} %d'
+                                     % (labels, bound, count))
+                    count += histogram.counts[-1]
+                    lines.append('bbj_request_seconds_bucket{%s,le="+Inf"} %d'
+                                 % (labels, count))
+                    lines.append("bbj_request_seconds_sum{%s} %r"
+                                 % (labels, histogram.sum))
+                    lines.append("bbj_request_seconds_count{%s} %d"
+                                 % (labels, count))
+
+        for name, type, help, values in others:
+            lines += ["# HELP %s %s" % (name, help), "# TYPE %s %s" % (name, type)]
+            for labels, value in values.items():
+                labels = ",".join('%s="%s"' % label for label in labels)
+                lines.append("%s%s %r" % (name, "{%s}" % labels if labels else "", value))
+        return "\n".join(lines) + "\n"
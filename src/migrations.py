@@ -0,0 +1,231 @@
+"""
+Versioned upgrades for existing databases. The version of a database is
+kept in SQLite's `user_version` pragma: a database made from schema.sql
+is always at the latest version, and older ones are brought up to date
+in place by running each missing migration in order (see dbupdate.py).
+
+To change the schema, add a function to the end of MIGRATIONS that takes
+a connection and performs the change, and make the same change to
+schema.sql, including the `user_version` pragma at its end. Migrations
+are run inside a transaction along with the version bump, so a failed
+migration leaves the database untouched.
+"""
+
+from src.exceptions import BBJException
+from src.utils import preview
+
+
+def has_column(connection, table, column):
+    return any(
+        info[1] == column for info in
+        connection.execute("PRAGMA table_info(%s)" % table))
+
+
+def add_last_author(connection):
+    """
+    Add threads.last_author, filled in from the last message of each
+    thread. This was formerly done by a one-off dbupdate.py.
+    """
+    if has_column(connection, "threads", "last_author"):
+        return
+    connection.execute('ALTER TABLE threads ADD COLUMN last_author text DEFAULT ""')
+    connection.execute("""
+        UPDATE threads SET last_author = (
+            SELECT author FROM messages
+              WHERE messages.thread_id = threads.thread_id
+              ORDER BY post_id DESC LIMIT 1)""")
+
+
+def add_keys_and_indexes(connection):
+    """
+    Give messages a primary key of (thread_id, post_id) and index the
+    columns used for lookups: user ids and names, thread ids, and the
+    timestamps the index and message feed are ordered by.
+    """
+    duplicates = connection.execute("""
+        SELECT thread_id, post_id FROM messages
+          GROUP BY thread_id, post_id
+          HAVING count(*) > 1""").fetchall()
+    if duplicates:
+        raise BBJException(1,
+            "Cannot add a primary key to messages, these (thread_id, post_id) "
+            "pairs occur more than once: {}".format(duplicates))
+
+    # SQLite cannot add a primary key to an existing table, so
+    # the messages table has to be rebuilt with one
+    connection.execute("""
+        CREATE TABLE messages_new (
+          thread_id text,
+          post_id int,
+          author text,
+          created real,
+          edited int,
+          body text,
+          send_raw int,
+          PRIMARY KEY (thread_id, post_id)
+        )""")
+    connection.execute("""
+        INSERT INTO messages_new
+          SELECT thread_id, post_id, author, created, edited, body, send_raw
+          FROM messages""")
+    connection.execute("DROP TABLE messages")
+    connection.execute("ALTER TABLE messages_new RENAME TO messages")
+
+    for statement in (
+            "CREATE UNIQUE INDEX IF NOT EXISTS users_user_id ON users(user_id)",
+            "CREATE UNIQUE INDEX IF NOT EXISTS users_user_name ON users(user_name)",
+            "CREATE UNIQUE INDEX IF NOT EXISTS threads_thread_id ON threads(thread_id)",
+            "CREATE INDEX IF NOT EXISTS threads_last_mod ON threads(last_mod)",
+            "CREATE INDEX IF NOT EXISTS messages_created "
+            "ON messages(created, thread_id, post_id)"):
+        connection.execute(statement)
+
+
+def add_message_last_mod(connection):
+    """
+    Add messages.last_mod, the time a message was posted or last edited,
+    so clients can fetch only the messages of a thread which changed.
+    Existing messages start out with their creation time.
+    """
+    if has_column(connection, "messages", "last_mod"):
+        return
+    connection.execute("ALTER TABLE messages ADD COLUMN last_mod real")
+    connection.execute("UPDATE messages SET last_mod = created")
+
+
+def add_thread_summary(connection):
+    """
+    Add the thread_summary table, which the server keeps up to date on
+    every write, and fill it in for the existing threads.
+    """
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS thread_summary (
+          thread_id text primary key,
+          op_preview text,
+          last_preview text,
+          participants int
+        )""")
+    fill_thread_summary(connection)
+
+
+def fill_thread_summary(connection):
+    """
+    Summarize every thread from its messages, replacing the summaries
+    already there.
+    """
+    connection.create_function("preview", 1, preview, deterministic=True)
+    connection.execute("""
+        INSERT OR REPLACE INTO thread_summary
+          SELECT thread_id,
+            (SELECT preview(body) FROM messages
+              WHERE messages.thread_id = threads.thread_id AND post_id = 0),
+            (SELECT preview(body) FROM messages
+              WHERE messages.thread_id = threads.thread_id
+              ORDER BY post_id DESC LIMIT 1),
+            (SELECT count(DISTINCT author) FROM messages
+              WHERE messages.thread_id = threads.thread_id
+                AND body != '[deleted]')
+          FROM threads""")
+
+
+def recount_participants(connection):
+    """
+    Count the participants of every thread again without its deleted
+    messages, which add_thread_summary counted as anon's.
+    """
+    connection.execute("""
+        UPDATE thread_summary SET
+        participants = (
+            SELECT count(DISTINCT author) FROM messages
+              WHERE messages.thread_id = thread_summary.thread_id
+                AND body != '[deleted]')""")
+
+
+def add_search(connection):
+    """
+    Add the full text search index, and index the existing messages.
+    """
+    connection.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS search
+          USING fts5(title, body, thread_id unindexed, post_id unindexed)""")
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS search_rows (
+          thread_id text,
+          post_id int,
+          search_rowid int,
+          PRIMARY KEY (thread_id, post_id)
+        ) WITHOUT ROWID""")
+    fill_search(connection)
+
+
+def fill_search(connection):
+    """
+    Index every message for search, replacing the whole index.
+    """
+    connection.execute("DELETE FROM search")
+    connection.execute("DELETE FROM search_rows")
+    # message_delete leaves deleted messages in place with this body
+    connection.execute("""
+        INSERT INTO search_rows
+          SELECT thread_id, post_id,
+                 row_number() OVER (ORDER BY thread_id, post_id)
+            FROM messages
+            WHERE body != '[deleted]'""")
+    connection.execute("""
+        INSERT INTO search (rowid, title, body, thread_id, post_id)
+          SELECT search_rowid,
+                 CASE WHEN messages.post_id = 0 THEN threads.title END,
+                 messages.body, messages.thread_id, messages.post_id
+            FROM search_rows
+            JOIN messages
+              ON messages.thread_id = search_rows.thread_id
+             AND messages.post_id = search_rows.post_id
+            JOIN threads ON threads.thread_id = messages.thread_id""")
+    connection.execute("INSERT INTO search (search) VALUES ('optimize')")
+
+
+# the version of a database is the number of these that have been applied
+MIGRATIONS = [
+    add_last_author,
+    add_keys_and_indexes,
+    add_message_last_mod,
+    add_thread_summary,
+    add_search,
+    recount_participants
+]
+
+
+def version(connection):
+    return connection.execute("PRAGMA user_version").fetchone()[0]
+
+
+def outdated(connection):
+    return version(connection) < len(MIGRATIONS)
+
+
+def upgrade(connection, log=None):
+    """
+    Apply every migration the database has not seen yet, each in its own
+    transaction. LOG, if given, is called with the name of each migration
+    before it runs. Returns the new version.
+    """
+    isolation_level = connection.isolation_level
+    # handle the transactions by hand, the sqlite3 module does
+    # not open them before schema changes on its own
+    connection.isolation_level = None
+    try:
+        for number in range(version(connection), len(MIGRATIONS)):
+            migration = MIGRATIONS[number]
+            if log:
+                log(migration.__name__)
+            connection.execute("BEGIN")
+            try:
+                migration(connection)
+                connection.execute("PRAGMA user_version = %d" % (number + 1))
+            except:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+    finally:
+        connection.isolation_level = isolation_level
+    return version(connection)
@@ -0,0 +1,137 @@
+"""
+A small pool of SQLite connections shared by the request threads, so
+that each request does not pay for opening the database file, parsing
+its schema and warming up a fresh page cache.
+
+Connections are checked for health when they are taken out of the pool
+and any transaction a request left open is rolled back when they are
+returned, so a connection always comes out in a clean state.
+"""
+
+from src.exceptions import BBJException
+from queue import LifoQueue, Empty
+from threading import Lock
+import sqlite3
+
+
+class ConnectionPool(object):
+    """
+    Hands out at most SIZE connections to the database at PATH at once.
+    When they are all in use, get() waits up to TIMEOUT seconds for one
+    to be returned before failing with a code 1 error. A SIZE of 0
+    disables pooling: every get() opens a new connection and put()
+    closes it again.
+
+    PRAGMAS is a list of (name, value) pairs that are applied once to
+    each connection when it is opened.
+    """
+    def __init__(self, path, size=10, timeout=10, pragmas=()):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = list(pragmas)
+        # LIFO, so the most recently used (and warmest) connection is reused
+        self.idle = LifoQueue()
+        self.opened = 0
+        self.lock = Lock()
+
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        for name, value in self.pragmas:
+            connection.execute("PRAGMA %s = %s" % (name, value))
+        return connection
+
+
+    def healthy(self, connection):
+        try:
+            connection.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+
+    def discard(self, connection):
+        with self.lock:
+            self.opened -= 1
+        try:
+            connection.close()
+        except sqlite3.Error:
+            pass
+
+
+    def get(self):
+        """
+        Take a connection out of the pool, opening a new one if
+        the pool is not full yet.
+        """
+        if not self.size:
+            return self.connect()
+
+        while True:
+            try:
+                connection = self.idle.get_nowait()
+            except Empty:
+                with self.lock:
+                    can_open = self.opened < self.size
+                    if can_open:
+                        self.opened += 1
+                if can_open:
+                    try:
+                        return self.connect()
+                    except:
+                        with self.lock:
+                            self.opened -= 1
+                        raise
+                try:
+                    connection = self.idle.get(timeout=self.timeout)
+                except Empty:
+                    raise BBJException(1,
+                        "Timed out waiting for a database connection.")
+
+            if self.healthy(connection):
+                return connection
+            self.discard(connection)
+
+
+    def put(self, connection):
+        """
+        Return a connection taken with get() to the pool.
+        """
+        if not self.size:
+            connection.close()
+            return
+
+        try:
+            if connection.in_transaction:
+                connection.rollback()
+        except sqlite3.Error:
+            self.discard(connection)
+            return
+        self.idle.put(connection)
+
+
+    def checkpoint(self, mode="PASSIVE"):
+        """
+        Copy the contents of the WAL back into the database. With the
+        default PASSIVE mode, this does as much as it can without waiting
+        on any reader or writer. Returns the (busy, log, checkpointed)
+        row from SQLite.
+        """
+        connection = self.get()
+        try:
+            return connection.execute(
+                "PRAGMA wal_checkpoint(%s)" % mode).fetchone()
+        finally:
+            self.put(connection)
+
+
+    def close(self):
+        """
+        Close all the idle connections.
+        """
+        while True:
+            try:
+                self.discard(self.idle.get_nowait())
+            except Empty:
+                break
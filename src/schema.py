@@ -143,6 +143,18 @@ def thread(
     }
 
 
+def thread_summary(
+        op_preview,    # string (start of the original post's body)
+        last_preview,  # string (start of the last message's body)
+        participants): # integer (distinct authors of its messages)
+
+    return {
+        "op_preview":   op_preview,
+        "last_preview": last_preview,
+        "participants": participants or 0
+    }
+
+
 def message(
         thread_id, # string (uuid1 of parent thread)
         post_id,   # integer (incrementing from 1)
@@ -150,7 +162,8 @@ def message(
         created,   # floating point unix timestamp (when reply was posted)
         edited,    # bool
         body,      # string
-        send_raw): # bool
+        send_raw,  # bool
+        last_mod): # floating point unix timestamp (of posting or last edit)
 
     return {
         "thread_id": thread_id,
@@ -159,5 +172,6 @@ def message(
         "created":   created,
         "edited":    bool(edited),
         "body":      body,
-        "send_raw":  bool(send_raw)
+        "send_raw":  bool(send_raw),
+        "last_mod":  last_mod
     }
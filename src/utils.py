@@ -1,5 +1,8 @@
 from src import schema
 
+# the most characters of a message body kept in a preview
+PREVIEW_LENGTH = 160
+
 def ordered_keys(subscriptable_object, *keys):
     """
     returns a tuple with the values for KEYS in the order KEYS are provided,
@@ -28,4 +31,15 @@ def schema_values(scheme, obj):
     elif scheme == "message":
         return ordered_keys(obj,
             "thread_id", "post_id", "author",
-            "created", "edited", "body", "send_raw")
+            "created", "edited", "body", "send_raw",
+            "last_mod")
+
+
+def preview(body):
+    """
+    Returns the start of the message BODY, on a single line, for
+    the thread summaries. The body is unformatted.
+    """
+    if body is None:
+        return None
+    return " ".join(body.split())[:PREVIEW_LENGTH]
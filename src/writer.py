@@ -0,0 +1,242 @@
+"""
+A queue of writes to the database, made one after another by a single
+writer thread on a connection of its own. Without it, every request that
+posts commits on its own and they all contend for SQLite's write lock:
+in a burst of replies, the ones that wait past busy_timeout fail.
+
+The writes that queue up while the writer is busy are made together in
+one transaction and committed at once (group commit), so a burst costs
+one commit per batch rather than one per write. Each write still runs in
+a savepoint of its own, so one that fails is rolled back by itself and
+its caller gets the exception, while the rest of the batch commits.
+
+The functions in db.py commit and publish their events themselves. The
+writer's connection ignores their commits, and their db.bump() calls are
+held until the batch has really been committed and its callers have
+been answered, so no reader ever hears of a write before it can see it.
+"""
+
+from src.exceptions import BBJException
+from concurrent.futures import Future, TimeoutError
+from queue import Queue, Empty, Full
+from threading import Thread, Lock
+from src import db
+import time
+
+
+class BatchConnection(object):
+    """
+    Stands in for the writer's CONNECTION while a write runs. The
+    writer commits the batch, so commit() does nothing, and rollback()
+    only rolls back the write.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+    def commit(self):
+        pass
+
+
+    def rollback(self):
+        self.connection.execute("ROLLBACK TO write")
+
+
+class WriteQueue(object):
+    """
+    Makes the writes given to submit() on a connection opened with
+    CONNECT. At most SIZE writes wait at once; submit() waits up to
+    TIMEOUT seconds for room before failing. A batch is at most
+    MAX_BATCH writes, and once the first one is taken, the writer waits
+    up to MAX_DELAY seconds for more to join it before writing it.
+    """
+    def __init__(self, connect, size=1000, timeout=10, max_batch=100, max_delay=0):
+        self.connect = connect
+        self.queue = Queue(size)
+        self.timeout = timeout
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.thread = None
+        self.lock = Lock()
+        self.writes = 0
+        self.failures = 0
+        self.batches = 0
+        self.largest_batch = 0
+        self.deepest_queue = 0
+
+
+    def start(self):
+        self.thread = Thread(target=self.run, name="bbj-writer", daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        """
+        Finish the writes already queued and stop the writer.
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+
+    def submit(self, function, *args):
+        """
+        Queue a call to FUNCTION(connection, *ARGS) and wait for it to be
+        committed. Returns what it returned, or raises what it raised.
+        Fails when it waits more than TIMEOUT seconds for room in the
+        queue, or as long again for the write to be made (which may then
+        still be made later).
+        """
+        future = Future()
+        try:
+            self.queue.put((future, function, args), timeout=self.timeout)
+        except Full:
+            raise BBJException(1, "Timed out waiting to write to the database.")
+        depth = self.queue.qsize()
+        if depth > self.deepest_queue:
+            self.deepest_queue = depth
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            raise BBJException(1, "Timed out waiting to write to the database.")
+
+
+    def take(self):
+        """
+        Wait for the next write and return it with the ones that join
+        it, or None when the writer is stopped.
+        """
+        first = self.queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    item = self.queue.get(timeout=remaining)
+                else:
+                    item = self.queue.get_nowait()
+            except Empty:
+                break
+            if item is None:
+                # stop once this batch is written
+                self.queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+
+    def run(self):
+        connection = None
+        while True:
+            batch = self.take()
+            if batch is None:
+                break
+            try:
+                if connection is None:
+                    connection = self.connect()
+                    # transactions are begun, committed and rolled back by hand
+                    connection.isolation_level = None
+                self.write(connection, BatchConnection(connection), batch)
+            except Exception as e:
+                # the connection can't be trusted any more: fail whatever
+                # is left of the batch, and open a new one for the next
+                print("write queue: " + repr(e))
+                self.resolve([(future, None, e) for future, _, _ in batch
+                              if not future.done()])
+                if connection is not None:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+                    connection = None
+        if connection is not None:
+            connection.close()
+
+
+    def write(self, connection, proxy, batch):
+        """
+        Make the writes in BATCH in one transaction, answer their callers
+        and then publish their bumps. Raises, once the callers have their
+        answers, when the transaction could not even be rolled back.
+        """
+        outcomes = []
+        broken = None
+        db.held.bumps = bumps = []
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            for future, function, args in batch:
+                held = len(bumps)
+                connection.execute("SAVEPOINT write")
+                try:
+                    outcomes.append((future, function(proxy, *args), None))
+                except Exception as e:
+                    connection.execute("ROLLBACK TO write")
+                    del bumps[held:]
+                    outcomes.append((future, None, e))
+                connection.execute("RELEASE write")
+            connection.execute("COMMIT")
+
+        except Exception as e:
+            # the batch could not be committed, so none of it was written
+            outcomes = [(future, None, e) for future, _, _ in batch]
+            bumps.clear()
+            try:
+                if connection.in_transaction:
+                    connection.execute("ROLLBACK")
+            except Exception as e:
+                broken = e
+
+        finally:
+            db.held.bumps = None
+
+        with self.lock:
+            self.batches += 1
+            self.writes += len(batch)
+            self.largest_batch = max(self.largest_batch, len(batch))
+        self.resolve(outcomes)
+
+        for thread_id, event, details in bumps:
+            try:
+                db.bump(thread_id, event, **details)
+            except Exception as e:
+                print("write queue: publishing a %s failed: %r" % (event, e))
+        if broken:
+            raise broken
+
+
+    def resolve(self, outcomes):
+        """
+        Answer the callers in OUTCOMES, a list of (future, result, error)
+        tuples, with their result, or their error when it is not None.
+        """
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                with self.lock:
+                    self.failures += 1
+                future.set_exception(error)
+
+
+    def stats(self):
+        """
+        Returns a dictionary with the number of writes waiting, the most
+        that have waited at once, and the counts of writes, failed writes
+        and batches made and the size of the largest batch.
+        """
+        with self.lock:
+            return {
+                "queued": self.queue.qsize(),
+                "deepest_queue": self.deepest_queue,
+                "writes": self.writes,
+                "failures": self.failures,
+                "batches": self.batches,
+                "largest_batch": self.largest_batch,
+                "mean_batch": self.writes / self.batches if self.batches else 0.0
+            }